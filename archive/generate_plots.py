@@ -1,8 +1,12 @@
 import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import signal
 
+sys.path.append('src/quori_exercises/scripts')
+from SessionDataset import SessionDataset
+
 def find_peaks(angles, segmenting_joints):
     grads = np.zeros_like(angles)
     peaks = []
@@ -52,11 +56,12 @@ def check_if_new_peak(angles, grads, peaks, peak_candidate, segmenting_joints, e
     return False
 
 
-filename = 'src/quori_exercises/experts/bicep_curls_demos.npz'
-
-npz_file = np.load(filename)
+#Demos come memory-mapped from the dataset cache
+dataset = SessionDataset()
+demos = dataset.recording('experts/bicep_curls_demos')
 
-angles = npz_file['angles']
+angles = demos.set(0)['angles']
+joint_names = demos.array('joints')
 
 fig, ax = plt.subplots(int(angles.shape[1]/2), 2,  sharex = True, sharey  = True)
 counter = [0, 0]
@@ -67,7 +72,7 @@ for ii in range(angles.shape[1]):
         current_column = 1
 
     ax[counter[current_column], current_column].plot(angles[:300, ii])
-    ax[counter[current_column], current_column].set_title('{}-{}-{}-{}'.format(npz_file['joints'][ii][0], npz_file['joints'][ii][1], npz_file['joints'][ii][2], npz_file['joints'][ii][3]))
+    ax[counter[current_column], current_column].set_title('{}-{}-{}-{}'.format(joint_names[ii][0], joint_names[ii][1], joint_names[ii][2], joint_names[ii][3]))
     counter[current_column] += 1
 
 
@@ -83,7 +88,7 @@ for ii in joints:
 
     ax[counter[current_column], current_column].plot(angles[:300, ii])
     ax[counter[current_column], current_column].plot(np.gradient(angles[:300, ii]), 'k')
-    ax[counter[current_column], current_column].set_title('{}-{}-{}-{}'.format(npz_file['joints'][ii][0], npz_file['joints'][ii][1], npz_file['joints'][ii][2], npz_file['joints'][ii][3]))
+    ax[counter[current_column], current_column].set_title('{}-{}-{}-{}'.format(joint_names[ii][0], joint_names[ii][1], joint_names[ii][2], joint_names[ii][3]))
     counter[current_column] += 1
 
 
@@ -122,7 +127,7 @@ for ii in segmenting_joints:
         p_counter += 1
 
     ax[counter[current_column], current_column].plot(angles[:300, ii], 'k', linestyle=':')
-    ax[counter[current_column], current_column].set_title('{}-{}-{}-{}'.format(npz_file['joints'][ii][0], npz_file['joints'][ii][1], npz_file['joints'][ii][2], npz_file['joints'][ii][3]))
+    ax[counter[current_column], current_column].set_title('{}-{}-{}-{}'.format(joint_names[ii][0], joint_names[ii][1], joint_names[ii][2], joint_names[ii][3]))
     counter[current_column] += 1
 
 
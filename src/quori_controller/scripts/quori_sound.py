@@ -1,32 +1,315 @@
 #!/usr/bin/env python3
 import os
+import sys
+import shutil
+import hashlib
+import time
+import queue
+import argparse
+import subprocess
+import threading
 import rospy
 from std_msgs.msg import String
-from gtts import gTTS
+from quori_controller.msg import SpeechRequest, SpeechQueueState, SpeechEvent
+from quori_controller.srv import GetSpeechDuration, GetSpeechDurationResponse
 import pygame
 from io import BytesIO
 
-def say(text):
-    tts = gTTS(text=text, lang='en')
-    fp = BytesIO()
-    tts.write_to_fp(fp)
-    fp.seek(0)
-    pygame.mixer.init()
-    pygame.mixer.music.load(fp)
-    pygame.mixer.music.play()
-    while pygame.mixer.music.get_busy():
-        pygame.time.Clock().tick(10)
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ros', 'quori_sound_cache')
 
-def callback(data):
-    say(data.data)
+class SpeechCache:
+
+    def __init__(self, directory=CACHE_DIR, voice='en-US', backend='auto'):
+        #Rendered audio is kept on disk keyed by backend, voice and text, and in memory once used
+        if backend == 'auto':
+            backend = 'pico2wave' if shutil.which('pico2wave') else 'espeak' if shutil.which('espeak') else 'gtts'
+        self.directory = directory
+        self.voice = voice
+        self.backend = backend
+        self.memory = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, text):
+        return hashlib.sha1('{}\n{}\n{}'.format(self.backend, self.voice, text).encode('utf-8')).hexdigest()
+
+    def path(self, text):
+        #Every backend ends up as wav, pygame Sounds do not load mp3 on most builds
+        return os.path.join(self.directory, self.key(text) + '.wav')
+
+    def get(self, text):
+        #Returns the encoded wav, rendering on a cache miss
+        key = self.key(text)
+        with self.lock:
+            audio = self.memory.get(key)
+        if audio is None:
+            path = self.path(text)
+            if not os.path.exists(path):
+                self.render(text, path)
+            with open(path, 'rb') as f:
+                audio = f.read()
+            with self.lock:
+                self.memory[key] = audio
+        return audio
+
+    def preload(self):
+        #Everything rendered before, so cache hits never touch the disk
+        for filename in os.listdir(self.directory):
+            key, ext = os.path.splitext(filename)
+            if ext == '.wav' and '.tmp' not in key:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    audio = f.read()
+                with self.lock:
+                    self.memory[key] = audio
+
+    def render(self, text, path):
+        #Rendered next to the final file then renamed, so an interrupted render is never cached.
+        #The temporary name is per thread so a second render of the same phrase cannot clobber it
+        tmp_path = '{}.tmp{}.wav'.format(os.path.splitext(path)[0], threading.get_ident())
+        if self.backend == 'pico2wave':
+            subprocess.run(['pico2wave', '-l', self.voice, '-w', tmp_path, text], check=True)
+        elif self.backend == 'espeak':
+            subprocess.run(['espeak', '-v', self.voice.lower(), '-w', tmp_path, text], check=True)
+        else:
+            #gTTS only produces mp3, converted with ffmpeg
+            from gtts import gTTS
+            if shutil.which('ffmpeg') is None:
+                raise RuntimeError('the gtts backend needs ffmpeg to convert its mp3 to wav')
+            mp3_path = tmp_path[:-len('.wav')] + '.mp3'
+            gTTS(text=text, lang=self.voice.split('-')[0]).save(mp3_path)
+            try:
+                subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', mp3_path, tmp_path], check=True)
+            finally:
+                os.remove(mp3_path)
+        os.replace(tmp_path, path)
+
+class AudioEngine:
+
+    def __init__(self, cache):
+        #The mixer stays open for the life of the node and utterances are decoded to PCM
+        #(pygame Sounds) before they are due, so playback starts as soon as it is popped
+        self.cache = cache
+        self.sounds = {}
+        #Phrases being rendered or decoded, key -> Event set when done, so each is done once
+        #and play() waits for the decoder instead of rendering the same phrase again
+        self.decoding = {}
+        self.lock = threading.Lock()
+        self.decode_queue = queue.Queue()
+        pygame.mixer.init()
+        self.channel = pygame.mixer.Channel(0)
+        self.event_pub = rospy.Publisher('quori_sound/events', SpeechEvent, queue_size=10)
+        self.decoder = threading.Thread(target=self.decoder_loop, name='quori_sound_decoder', daemon=True)
+        self.decoder.start()
+
+    def preload(self):
+        with self.cache.lock:
+            cached = list(self.cache.memory.items())
+        for key, audio in cached:
+            sound = pygame.mixer.Sound(file=BytesIO(audio))
+            with self.lock:
+                self.sounds[key] = sound
+
+    def prepare(self, text):
+        #Decoded on the decoder thread, a cache miss never holds up what is playing
+        self.decode_queue.put(text)
+
+    def decoder_loop(self):
+        while not rospy.is_shutdown():
+            text = self.decode_queue.get()
+            try:
+                self.sound(text)
+            except Exception as e:
+                rospy.logwarn('Could not render "{}": {}'.format(text, e))
+
+    def sound(self, text):
+        key = self.cache.key(text)
+        with self.lock:
+            sound = self.sounds.get(key)
+            done = self.decoding.get(key)
+            owner = sound is None and done is None
+            if owner:
+                done = threading.Event()
+                self.decoding[key] = done
+        if sound is not None:
+            return sound
+
+        if not owner:
+            #Another thread is already on it
+            done.wait()
+            with self.lock:
+                sound = self.sounds.get(key)
+            if sound is None:
+                raise RuntimeError('decoding failed on another thread')
+            return sound
+
+        try:
+            sound = pygame.mixer.Sound(file=BytesIO(self.cache.get(text)))
+            with self.lock:
+                self.sounds[key] = sound
+        finally:
+            with self.lock:
+                del self.decoding[key]
+            done.set()
+        return sound
+
+    def duration(self, text):
+        #Known length of a decoded phrase, -1 (and start decoding it) otherwise
+        with self.lock:
+            sound = self.sounds.get(self.cache.key(text))
+        if sound is None:
+            self.prepare(text)
+            return -1.0
+        return sound.get_length()
+
+    def handle_duration(self, req):
+        return GetSpeechDurationResponse([self.duration(text) for text in req.texts])
+
+    def play(self, request):
+        #Blocks until the utterance is over, with start and stop events around it
+        sound = self.sound(request.text)
+        length = sound.get_length()
+        self.publish_event(SpeechEvent.START, request, length)
+
+        start = time.monotonic()
+        self.channel.play(sound)
+        #Sleep through most of it, then poll for the tail
+        time.sleep(max(0.0, length - 0.05))
+        while self.channel.get_busy() and not rospy.is_shutdown():
+            time.sleep(0.01)
+
+        completed = not self.channel.get_busy()
+        if not completed:
+            self.channel.stop()
+        self.publish_event(SpeechEvent.STOP, request, time.monotonic() - start, completed)
+
+    def publish_event(self, event, request, duration, completed=False):
+        msg = SpeechEvent(event=event, text=request.text, key=request.key, duration=duration, completed=completed)
+        msg.header.stamp = rospy.Time.now()
+        self.event_pub.publish(msg)
+
+class SpeechQueue:
+
+    def __init__(self):
+        #Pending requests as (priority, arrival, deadline, request), spoken highest priority
+        #first and in arrival order within a priority
+        self.pending = []
+        self.arrivals = 0
+        self.speaking = None
+        self.expired = 0
+        self.replaced = 0
+        self.condition = threading.Condition()
+        self.state_pub = rospy.Publisher('quori_sound/state', SpeechQueueState, queue_size=10, latch=True)
+
+    def push(self, request):
+        stamp = request.header.stamp.to_sec() if not request.header.stamp.is_zero() else rospy.get_time()
+        deadline = stamp + request.ttl if request.ttl > 0 else None
+
+        with self.condition:
+            #Newer feedback for the same key replaces whatever has not been said yet
+            if request.key != '':
+                kept = [entry for entry in self.pending if entry[3].key != request.key]
+                self.replaced += len(self.pending) - len(kept)
+                self.pending = kept
+
+            self.pending.append((request.priority, self.arrivals, deadline, request))
+            self.arrivals += 1
+            self.pending.sort(key=lambda entry: (-entry[0], entry[1]))
+            self.condition.notify()
+        self.publish_state()
+
+    def pop(self):
+        #Blocks until there is something to say, skipping requests that expired while waiting
+        with self.condition:
+            while not rospy.is_shutdown():
+                now = rospy.get_time()
+                kept = [entry for entry in self.pending if entry[2] is None or entry[2] >= now]
+                self.expired += len(self.pending) - len(kept)
+                self.pending = kept
+                if len(self.pending) > 0:
+                    self.speaking = self.pending.pop(0)[3]
+                    return self.speaking
+                self.condition.wait(0.5)
+
+    def done(self):
+        with self.condition:
+            self.speaking = None
+        self.publish_state()
+
+    def publish_state(self):
+        with self.condition:
+            state = SpeechQueueState()
+            state.header.stamp = rospy.Time.now()
+            if self.speaking is not None:
+                state.speaking = self.speaking.text
+                state.speaking_key = self.speaking.key
+            state.pending = [entry[3].text for entry in self.pending]
+            state.pending_keys = [entry[3].key for entry in self.pending]
+            state.expired = self.expired
+            state.replaced = self.replaced
+        self.state_pub.publish(state)
+
+def speaker(speech_queue, engine):
+    #Utterances are played here so the subscriber callbacks never block
+    while not rospy.is_shutdown():
+        request = speech_queue.pop()
+        if request is None:
+            break
+        speech_queue.publish_state()
+        try:
+            engine.play(request)
+        except Exception as e:
+            rospy.logwarn('Could not say "{}": {}'.format(request.text, e))
+            engine.publish_event(SpeechEvent.STOP, request, 0.0)
+        speech_queue.done()
 
 def listener():
     rospy.init_node('quori_sound', anonymous=True)
 
-    rospy.Subscriber("quori_sound", String, callback)
+    cache = SpeechCache(rospy.get_param('~cache_dir', CACHE_DIR), rospy.get_param('~voice', 'en-US'), rospy.get_param('~tts_backend', 'auto'))
+    cache.preload()
+    engine = AudioEngine(cache)
+    engine.preload()
+    rospy.loginfo('quori_sound using {} voice {}, {} phrases cached in {}'.format(cache.backend, cache.voice, len(cache.memory), cache.directory))
+    speech_queue = SpeechQueue()
+
+    #Decoding starts as soon as a request arrives, while it waits its turn
+    def on_request(request):
+        engine.prepare(request.text)
+        speech_queue.push(request)
+
+    #Plain strings are queued like FeedbackController session messages: priority 2, no key and no expiry
+    def on_string(data):
+        on_request(SpeechRequest(text=data.data, priority=2))
+
+    rospy.Subscriber("quori_sound", String, on_string)
+    rospy.Subscriber("quori_sound/request", SpeechRequest, on_request)
+    rospy.Service('quori_sound/get_duration', GetSpeechDuration, engine.handle_duration)
+    speech_queue.publish_state()
+
+    speaker_thread = threading.Thread(target=speaker, args=(speech_queue, engine), daemon=True)
+    speaker_thread.start()
 
     rospy.spin()
 
+def prerender(filename, cache):
+    #Renders every phrase (one per line) into the disk cache, no ROS master needed
+    f = sys.stdin if filename == '-' else open(filename)
+    phrases = [line.strip() for line in f if len(line.strip()) > 0]
+    for i, text in enumerate(phrases):
+        cached = os.path.exists(cache.path(text))
+        cache.get(text)
+        print('[{}/{}] {} {}'.format(i+1, len(phrases), 'cached' if cached else 'rendered', text))
+
 if __name__ == '__main__':
-    pygame.init()
-    listener()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Queue and play robot speech')
+    parser.add_argument('--prerender', metavar='PHRASES', help='render phrases from a file (- for stdin) into the cache and exit')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--voice', default='en-US')
+    parser.add_argument('--tts-backend', default='auto', choices=['auto', 'pico2wave', 'espeak', 'gtts'])
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    if args.prerender is not None:
+        prerender(args.prerender, SpeechCache(args.cache_dir, args.voice, args.tts_backend))
+    else:
+        listener()
+
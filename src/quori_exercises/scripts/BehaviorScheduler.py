@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import threading
+import rospy
+
+from Clock import WallClock
+
+class BehaviorScheduler:
+
+    def __init__(self, rate=50, clock=None):
+        #Keyframes per channel ('body', 'face', ...) as (due time, publish function, message, preemptible),
+        #sorted by time
+        self.keyframes = {}
+        self.condition = threading.Condition()
+        #Held from taking keyframes off the timeline until they are published, so the timer and a
+        #caller dispatching at the same time cannot publish out of order
+        self.dispatch_lock = threading.RLock()
+        self.clock = clock if clock is not None else WallClock()
+        self.timer = self.clock.timer(1.0/rate, self.dispatch)
+
+    def schedule(self, channel, keyframes, preempt=False, delay=0):
+        #keyframes is a list of (seconds from start, publish function, message). The behavior is
+        #merged into the channel's timeline and starts once what is pending is done. With preempt
+        #it first drops pending keyframes that were also scheduled with preempt (feedback gestures
+        #replacing stale ones), anything else on the channel (posture moves) is always kept
+        now = self.clock.monotonic()
+        with self.condition:
+            pending = self.keyframes.setdefault(channel, [])
+            if preempt:
+                pending[:] = [keyframe for keyframe in pending if not keyframe[3]]
+            start = max(now + delay, pending[-1][0]) if len(pending) > 0 else now + delay
+
+            for offset, publish, msg in keyframes:
+                pending.append((start + offset, publish, msg, preempt))
+            pending.sort(key=lambda keyframe: keyframe[0])
+
+        #Keyframes due right away go out on the caller's thread
+        self.dispatch()
+        return start + max([offset for offset, publish, msg in keyframes] + [0])
+
+    def cancel(self, channel):
+        with self.condition:
+            self.keyframes.pop(channel, None)
+            self.condition.notify_all()
+
+    def dispatch(self):
+        with self.dispatch_lock:
+            now = self.clock.monotonic()
+            due = []
+            with self.condition:
+                for channel, pending in self.keyframes.items():
+                    while len(pending) > 0 and pending[0][0] <= now:
+                        due.append(pending.pop(0))
+
+            for due_time, publish, msg, preemptible in sorted(due, key=lambda keyframe: keyframe[0]):
+                publish(msg)
+
+        if len(due) > 0:
+            with self.condition:
+                self.condition.notify_all()
+
+    def is_idle(self, channel):
+        with self.condition:
+            return len(self.keyframes.get(channel, [])) == 0
+
+    def wait(self, channel):
+        #Block until every keyframe on the channel has been published
+        with self.condition:
+            while len(self.keyframes.get(channel, [])) > 0 and not rospy.is_shutdown():
+                self.clock.wait(self.condition, 0.1)
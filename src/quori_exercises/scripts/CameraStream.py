@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import threading
+import time
+import numpy as np
+import rospy
+from sensor_msgs.msg import Image
+
+class CameraStream:
+
+    def __init__(self, topic="/astra_ros/devices/default/color/image_color"):
+        #Single subscription to the camera, every frame is decoded once and shared
+        self.sub = rospy.Subscriber(topic, Image, self.callback, queue_size=1, buff_size=2**24)
+        self.condition = threading.Condition()
+        self.frame = None
+        self.stamp = None
+        self.seq = 0
+        self.consumers = []
+
+    def callback(self, data):
+        #Read-only view onto the message buffer, no copy is made
+        image = np.frombuffer(data.data, dtype=np.uint8).reshape(
+            data.height, data.width, -1)
+
+        with self.condition:
+            self.frame = image
+            self.stamp = data.header.stamp
+            self.seq += 1
+            self.condition.notify_all()
+
+    def wait_for_frame(self, last_seq, timeout=1.0):
+        #Block until a frame newer than last_seq is available
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq != last_seq, timeout)
+            return self.seq, self.stamp, self.frame
+
+    def add_consumer(self, callback, rate=0, name='consumer'):
+        consumer = FrameConsumer(self, callback, rate, name)
+        self.consumers.append(consumer)
+        consumer.start()
+        return consumer
+
+    def unregister(self):
+        self.sub.unregister()
+        for consumer in self.consumers:
+            consumer.stop()
+
+
+class FrameConsumer:
+
+    def __init__(self, stream, callback, rate=0, name='consumer'):
+        #Each consumer gets the latest frame on its own thread, at most rate Hz (0 = every frame)
+        self.stream = stream
+        self.callback = callback
+        self.period = 1.0/rate if rate > 0 else 0
+        self.name = name
+        self.running = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        last_seq = 0
+        last_start = 0
+        while self.running and not rospy.is_shutdown():
+            #Throttle before picking up a frame so we always process the newest one
+            if self.period > 0:
+                wait = last_start + self.period - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+            seq, stamp, frame = self.stream.wait_for_frame(last_seq)
+            if seq == last_seq or frame is None:
+                continue
+            last_seq = seq
+            last_start = time.monotonic()
+
+            try:
+                self.callback(frame, stamp)
+            except Exception as e:
+                rospy.logerr('{} failed on frame {}: {}'.format(self.name, seq, e))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import time
+from datetime import datetime
+import rospy
+
+class WallClock:
+    #Real time, used on the robot
+
+    def now(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def datetime(self, tz):
+        return datetime.now(tz)
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def timer(self, period, callback):
+        #callback() every period seconds
+        return rospy.Timer(rospy.Duration(period), lambda event: callback())
+
+    def wait(self, condition, timeout):
+        #condition must be held by the caller
+        condition.wait(timeout)
+
+
+class VirtualClock:
+    #Time only moves when it is set or advanced, so recorded sessions can be replayed as fast
+    #as they can be evaluated. Timers fire on every advance instead of at their period
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self.callbacks = []
+
+    def now(self):
+        return self.time
+
+    def monotonic(self):
+        return self.time
+
+    def datetime(self, tz):
+        return datetime.fromtimestamp(self.time, tz)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def timer(self, period, callback):
+        self.callbacks.append(callback)
+        return callback
+
+    def wait(self, condition, timeout):
+        #Nothing else can change the state being waited on, so move time forward instead
+        self.advance(timeout)
+
+    def set(self, t):
+        #Never goes backwards
+        if t > self.time:
+            self.time = t
+        for callback in self.callbacks:
+            callback()
+
+    def advance(self, seconds):
+        self.set(self.time + seconds)
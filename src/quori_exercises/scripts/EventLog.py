@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+import threading
+
+#Logging for the real-time parts of a session: callers only put records on a queue, a
+#background thread formats and writes them. Set up once per process with setup_logging.
+
+class LogFileHandler(logging.Handler):
+
+    def __init__(self, formatter):
+        #File target that can be switched between sets without touching the root logger
+        logging.Handler.__init__(self)
+        self.formatter = formatter
+        self.file_handler = None
+
+    def set_path(self, path):
+        self.acquire()
+        try:
+            if self.file_handler is not None:
+                self.file_handler.close()
+            self.file_handler = None
+            if path is not None:
+                self.file_handler = logging.FileHandler(path)
+                self.file_handler.setFormatter(self.formatter)
+        finally:
+            self.release()
+
+    def emit(self, record):
+        #Switches come through the queue so records from the previous set still go to its file
+        if hasattr(record, 'log_path'):
+            self.set_path(record.log_path)
+        elif self.file_handler is not None:
+            self.file_handler.emit(record)
+
+    def close(self):
+        self.set_path(None)
+        logging.Handler.close(self)
+
+
+class EventLog:
+
+    def __init__(self):
+        #Structured records, one JSON object per line
+        self.queue = queue.Queue()
+        self.file = None
+        self.thread = threading.Thread(target=self.run, name='event_log', daemon=True)
+        self.thread.start()
+
+    def open(self, path):
+        self.queue.put(('open', path))
+
+    def log(self, event, stamp=None, **fields):
+        #stamp defaults to wall time, replays pass their virtual time
+        record = {'time': time.time() if stamp is None else stamp, 'event': event}
+        record.update(fields)
+        self.queue.put(('record', record))
+
+    def close(self):
+        self.queue.put(('close', None))
+        self.thread.join(timeout=5.0)
+
+    def run(self):
+        while True:
+            command, value = self.queue.get()
+            if command == 'record':
+                if self.file is not None:
+                    self.file.write(json.dumps(value, default=to_json) + '\n')
+            elif command == 'open':
+                if self.file is not None:
+                    self.file.close()
+                self.file = open(value, 'a')
+            elif command == 'close':
+                if self.file is not None:
+                    self.file.close()
+                self.file = None
+                return
+
+            #Flush once the burst has been written
+            if self.file is not None and self.queue.empty():
+                self.file.flush()
+
+
+def to_json(value):
+    #numpy scalars and arrays
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def read_events(path, event=None):
+    #Offline reader, optionally only one kind of event
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            record = json.loads(line)
+            if event is None or record['event'] == event:
+                yield record
+
+
+_listener = None
+_log_queue = None
+_log_file = None
+_event_log = None
+
+def setup_logging(log_path=None, event_path=None):
+    #Safe to call for every set, handlers are only installed the first time
+    global _listener, _log_queue, _log_file, _event_log
+    logger = logging.getLogger()
+
+    if _listener is None:
+        formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
+        stdout_handler = logging.StreamHandler(sys.stdout)
+        stdout_handler.setLevel(logging.DEBUG)
+        stdout_handler.setFormatter(formatter)
+        _log_file = LogFileHandler(formatter)
+        _log_file.set_path(log_path)
+
+        _log_queue = queue.Queue(-1)
+        _listener = logging.handlers.QueueListener(_log_queue, stdout_handler, _log_file, respect_handler_level=True)
+        logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+        if logger.level == logging.NOTSET or logger.level > logging.INFO:
+            logger.setLevel(logging.INFO)
+        _listener.start()
+
+        _event_log = EventLog()
+        atexit.register(shutdown_logging)
+    else:
+        #Level 0 record, below the stdout handler's level so only the file handler sees it
+        _log_queue.put_nowait(logging.makeLogRecord({'levelno': logging.NOTSET, 'log_path': log_path}))
+
+    if event_path is not None:
+        _event_log.open(event_path)
+
+    return logger, _event_log
+
+
+def shutdown_logging():
+    #Writes out everything still queued
+    global _listener, _event_log
+    if _listener is not None:
+        _listener.stop()
+        _log_file.close()
+        _listener = None
+    if _event_log is not None:
+        _event_log.close()
+        _event_log = None
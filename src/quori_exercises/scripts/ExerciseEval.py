@@ -6,20 +6,38 @@ from scipy.spatial.distance import euclidean
 import matplotlib.pyplot as plt
 import multiprocessing
 import rospy
-from std_msgs.msg import Float64MultiArray, String
-from datetime import datetime
+from std_msgs.msg import Float64MultiArray, String, Bool
+from std_srvs.srv import SetBool
+from rospy.numpy_msg import numpy_msg
+from quori_exercises.msg import JointAngles
 from pytz import timezone
 import time
+import queue
+import threading
+
+#Expert templates in each DTW worker process, sent once when the pool starts
+worker_experts = {}
+
+def init_dist_worker(experts):
+    global worker_experts
+    worker_experts = experts
+
+def dist_to_expert(args):
+    exercise_name, ind, current_rep, joints = args
+    return fastdtw(current_rep, worker_experts[exercise_name][ind][:,joints], dist=euclidean)[0]
 
 class ExerciseEval:
 
-    def __init__(self, replay, feedback_controller):
+    def __init__(self, replay, feedback_controller, clock=None, exercises=('bicep_curls', 'lateral_raises')):
         self.replay = replay
         self.flag = False
+        #Same clock as the feedback controller unless told otherwise
+        self.clock = clock if clock is not None else feedback_controller.clock
 
         if not self.replay:
             #Initialize the subscribers
-            self.pose_sub = rospy.Subscriber("joint_angles", Float64MultiArray, self.pose_callback, queue_size=10)
+            self.pose_sub = rospy.Subscriber("joint_angles_stamped", numpy_msg(JointAngles), self.pose_callback, queue_size=10)
+            self.tracking_srv = rospy.ServiceProxy('pose_tracking/set_active', SetBool)
 
         self.threshold1 = [1500, 1700]
         self.threshold2 = [2000, 2000]
@@ -34,7 +52,7 @@ class ExerciseEval:
         self.good_experts = {}
         self.joint_groups = {}
         self.joint_to_groups = {}
-        for exercise_name in ['bicep_curls', 'lateral_raises']:
+        for exercise_name in exercises:
             npzfile = np.load('src/quori_exercises/experts/{}_experts.npz'.format(exercise_name), allow_pickle=True)
             self.joints[exercise_name], self.experts[exercise_name], self.expert_duration[exercise_name], self.segmenting_joints[exercise_name], self.labels[exercise_name] = npzfile['joints'], npzfile['experts'], npzfile['expert_duration'], npzfile['segmenting_joints'], npzfile['labels']
             self.good_experts[exercise_name] = np.array([ii for ii, label in enumerate(self.labels[exercise_name]) if 'Good' in label]).astype(int)
@@ -42,6 +60,12 @@ class ExerciseEval:
                 self.segmenting_joints[exercise_name] = [0] + self.segmenting_joints[exercise_name]
             self.set_joint_groups(exercise_name)
 
+        #DTW workers live as long as this object, so a rep only ships the rep itself. They are
+        #spawned rather than forked, rospy's threads (and their locks) are already running
+        self.pool = multiprocessing.get_context('spawn').Pool(initializer=init_dist_worker, initargs=(self.experts,))
+        if not self.replay:
+            rospy.on_shutdown(self.close)
+
         self.angles = []
         self.performance = []
         self.peaks = []
@@ -49,8 +73,32 @@ class ExerciseEval:
         self.times = []
         self.current_exercise = ''
         self.exercise_name_list = []
+        self.current_round = 0
+        self.current_set = 0
+
+        #RepStore.RepStore that gets a row per rep and joint group, if set
+        self.rep_store = None
+
+        #Sequence numbers from pose_tracking.py, used to detect dropped frames
+        self.last_seq = None
+        self.dropped_frames = 0
+
+        #Called with the number of reps in the current set whenever a new peak is found
+        self.rep_callbacks = []
 
-    def start_new_set(self, exercise_name):
+        #Set on every frame received, finish_set waits for the one that evaluates the last rep
+        self.new_frame = threading.Event()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def start_new_set(self, exercise_name, round_num=0, set_num=None):
+        #set_num defaults to the number of sets of this exercise so far
+        if set_num is None:
+            set_num = self.exercise_name_list.count(exercise_name) + 1
+        self.current_round = round_num
+        self.current_set = set_num
         self.angles.append(np.empty((0, len(self.joints[exercise_name]))))
         self.performance.append(np.empty((0, len(self.joint_groups[exercise_name]))))
         self.peaks.append([])
@@ -59,6 +107,46 @@ class ExerciseEval:
         self.current_exercise = exercise_name
         self.exercise_name_list.append(exercise_name)
 
+    def finish_set(self, timeout=1.0):
+        #Stops recording, then pauses tracking once the frame that evaluates the last rep is in
+        self.new_frame.clear()
+        self.flag = False
+        if not self.replay:
+            self.new_frame.wait(timeout)
+        self.set_tracking(False)
+
+    def set_tracking(self, active):
+        #Pause pose inference when angles are not needed (rests, robot speech)
+        if self.replay:
+            return
+        try:
+            self.tracking_srv.wait_for_service(timeout=1.0)
+            self.tracking_srv(active)
+        except (rospy.ROSException, rospy.ServiceException) as e:
+            self.feedback_controller.logger.info('Could not set pose tracking to {}: {}'.format(active, e))
+
+    def wait_for_tracking(self, timeout=60):
+        #Block until pose_tracking.py reports its models are warmed up
+        if self.replay:
+            return
+        start = time.time()
+        ready = threading.Event()
+        #The topic is latched, so the current state arrives as soon as this subscribes
+        ready_sub = rospy.Subscriber('pose_tracking/ready', Bool, lambda msg: ready.set() if msg.data else None)
+        try:
+            while not rospy.is_shutdown() and not ready.is_set():
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    break
+                ready.wait(min(remaining, 0.5))
+        finally:
+            ready_sub.unregister()
+
+        if ready.is_set():
+            self.feedback_controller.logger.info('Pose tracking ready after {:.1f} s'.format(time.time() - start))
+        else:
+            self.feedback_controller.logger.info('Pose tracking not ready after {} s'.format(timeout))
+
     def find_peaks(self,angles):
         grads = np.zeros_like(angles)
         peaks = []
@@ -123,31 +211,18 @@ class ExerciseEval:
         
         self.joint_to_groups[exercise_name] = np.array(joint_to_groups).astype(int)
 
-    def calc_dist_worker(self, ind, series1, series2, q):
-            q.put((ind, fastdtw(series1, series2, dist=euclidean)))
-
     def calc_dist(self, current_rep, joints):
-
-        input_values = [self.experts[self.current_exercise][ii][:,joints] for ii in range(len(self.experts[self.current_exercise]))]
-        qout = multiprocessing.Queue()
-        processes = [multiprocessing.Process(target=self.calc_dist_worker, args=(ind, current_rep, val, qout))
-                for ind, val in enumerate(input_values)]
-        
-        for p in processes:
-            p.start()
-
-        for p in processes:
-            p.join()
-
-        unsorted_result = [qout.get() for p in processes]
-        result = [t[1][0] for t in sorted(unsorted_result)]
-
-        return result
+        #Distance to every expert of the current exercise, in expert order
+        tasks = [(self.current_exercise, ii, current_rep, joints) for ii in range(len(self.experts[self.current_exercise]))]
+        return self.pool.map(dist_to_expert, tasks)
 
     def evaluate_rep(self, current_rep, rep_duration):
 
         corrections = []
+        #Corrections without the joint group, as stored per group
+        correction_cases = []
         eval_list = []
+        distances = []
 
         for joint_group, joints in self.joint_groups[self.current_exercise].items():
             
@@ -168,7 +243,7 @@ class ExerciseEval:
             closest_expert = np.argmin(expert_distances)
             best_distance = np.min(expert_distances)
             expert_label = self.labels[self.current_exercise][closest_expert]
-            self.feedback_controller.logger.info('Good expert min {} All expert min {}'.format(np.min(good_distances), np.min(expert_distances)))
+            distances.append({'good': np.min(good_distances), 'all': best_distance, 'expert': int(closest_expert), 'label': expert_label})
 
 
             if best_distance < threshold1:
@@ -188,8 +263,8 @@ class ExerciseEval:
                 correction = 'bad'
                 eval_list.append(-1)
             
-            correction += ' {}'.format(joint_group)
-            corrections.append(correction)
+            correction_cases.append(correction)
+            corrections.append('{} {}'.format(correction, joint_group))
         
         if rep_duration < np.mean(self.expert_duration[self.current_exercise]) - 3:
             speed = 'fast'
@@ -198,19 +273,64 @@ class ExerciseEval:
         else:
             speed = 'good'
         
-        self.feedback_controller.logger.info('Actual Duration {}, Average Expert Duration {}'.format(rep_duration, np.mean(self.expert_duration[self.current_exercise])))
 
         feedback = {'speed': speed, 'correction': corrections, 'evaluation': eval_list}
 
         self.feedback[-1].append(feedback)
         self.performance[-1] = np.vstack((self.performance[-1], feedback['evaluation']))
         
-        self.feedback_controller.logger.info(feedback)
-        self.feedback_controller.react(self.feedback[-1], self.current_exercise)
+        self.feedback_controller.logger.info('Rep {}: speed {}, {}'.format(len(self.feedback[-1]), speed, ', '.join(corrections)))
+        self.feedback_controller.log_event('rep_evaluation', exercise=self.current_exercise, set=len(self.feedback) - 1,
+                                           rep=len(self.feedback[-1]), duration=rep_duration,
+                                           expert_duration=np.mean(self.expert_duration[self.current_exercise]),
+                                           distances=distances, **feedback)
+        reaction = self.feedback_controller.react(self.feedback[-1], self.current_exercise)
+
+        if self.rep_store is not None:
+            #Both live callers evaluate the rep between the last two peaks
+            start, end = self.peaks[-1][-2], self.peaks[-1][-1]
+            for group_ind, joint_group in enumerate(self.joint_groups[self.current_exercise]):
+                self.rep_store.append(round=self.current_round, exercise=self.current_exercise, set=self.current_set,
+                                      rep=len(self.feedback[-1]), start=start, end=end,
+                                      start_time=self.times[-1][start].timestamp(), duration=rep_duration, speed=speed,
+                                      group=joint_group, distance_good=distances[group_ind]['good'],
+                                      distance_all=distances[group_ind]['all'], expert=distances[group_ind]['expert'],
+                                      label=distances[group_ind]['label'], correction=correction_cases[group_ind],
+                                      evaluation=eval_list[group_ind], **reaction)
 
         return feedback
 
+    def connect_local(self, pose_tracking):
+        #In-process mode: angles come straight from PoseTracking through a queue instead of
+        #the joint_angles_stamped topic, which stays available for other listeners
+        if not self.replay:
+            self.pose_sub.unregister()
+        self.local_queue = queue.Queue(maxsize=100)
+        pose_tracking.listeners.append(self.local_queue)
+        self.local_thread = threading.Thread(target=self.local_worker, daemon=True)
+        self.local_thread.start()
+
+    def local_worker(self):
+        while not rospy.is_shutdown():
+            try:
+                seq, angles = self.local_queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            self.receive(seq, angles)
+
     def pose_callback(self, angle_data):
+        self.receive(angle_data.seq, angle_data.angles)
+
+    def receive(self, seq, angles):
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            self.dropped_frames += seq - self.last_seq - 1
+            self.feedback_controller.logger.info('Dropped {} pose frames ({} total)'.format(seq - self.last_seq - 1, self.dropped_frames))
+        self.last_seq = seq
+
+        self.ingest(angles)
+        self.new_frame.set()
+
+    def ingest(self, angle):
 
         if len(self.angles) == 0 or len(self.peaks) == 0:
             return
@@ -229,12 +349,10 @@ class ExerciseEval:
 
                 return
 
-        #Read angle from message
-        angle = angle_data.data
-        self.angles[-1] = np.vstack((self.angles[-1], np.array(angle)))
+        self.angles[-1] = np.vstack((self.angles[-1], angle))
 
         #Get time
-        time = datetime.now(timezone('EST'))
+        time = self.clock.datetime(timezone('EST'))
         self.times[-1].append(time)
 
         #Look for new peaks
@@ -255,6 +373,9 @@ class ExerciseEval:
                         current_rep = self.angles[-1][self.peaks[-1][-2]:self.peaks[-1][-1],:]
                         rep_duration = (self.times[-1][self.peaks[-1][-1]] - self.times[-1][self.peaks[-1][-2]]).total_seconds()
                         self.evaluate_rep(current_rep, rep_duration)
+
+                    for callback in self.rep_callbacks:
+                        callback(len(self.peaks[-1]) - 1)
                                           
     def reeval(self):
         for index, angle in enumerate(self.angles):
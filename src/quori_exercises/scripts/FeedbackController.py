@@ -1,44 +1,156 @@
 #!/usr/bin/env python3
-import logging
-import sys
-from datetime import datetime, timedelta
+import os
+from datetime import timedelta
 from pytz import timezone
 import numpy as np
-from std_msgs.msg import Float64MultiArray, String
+from collections import Counter
+from std_msgs.msg import Float64MultiArray
 from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
+from quori_controller.msg import SpeechRequest, SpeechQueueState, SpeechEvent
+from quori_controller.srv import GetSpeechDuration
 import rospy
 import syllables
-import time
+
+from BehaviorScheduler import BehaviorScheduler
+from Clock import WallClock
+from EventLog import setup_logging
+
+#Seconds rep feedback may wait in quori_sound's queue before it is no longer worth saying
+FEEDBACK_TTL = 4.0
+
+#Feedback options for each case, keyed by (case, exercise) where exercise None covers every
+#other exercise, then by robot number. Compiled per robot in FeedbackController.__init__
+FEEDBACK_MESSAGES = {
+    #Right low range of motion
+    ('1a', 'bicep_curls'): {1: [''],
+                            2: ['Focus on fully extending your right elbow.', 'Extend your right elbow more.'],
+                            3: ['Great work. Can you focus on extending your right elbow?', 'Great job. Can you try extending your right elbow a bit more?']},
+    ('1a', None): {1: [''],
+                   2: ['Focus on fully extending your right arm to 90 degrees.', 'Make sure your right arm reaches 90 degrees'],
+                   3: ['Great job, try to reach your right arm closer to 90 degrees.', 'Nice, can you reach your right arm closer to 90 degrees?']},
+    #Left low range of motion
+    ('1b', 'bicep_curls'): {1: [''],
+                            2: ['Focus on fully extending your left elbow.', 'Extend your left elbow more.'],
+                            3: ['Great work. Can you focus on extending your left elbow?', 'Great job. Can you try extending your left elbow a bit more?']},
+    ('1b', None): {1: [''],
+                   2: ['Focus on fully extending your left arm to 90 degrees.', 'Make sure your left arm reaches 90 degrees'],
+                   3: ['Great job, try to reach your left arm closer to 90 degrees.', 'Nice, can you reach your left arm closer to 90 degrees?']},
+    #Both sides low range of motion
+    ('1c', 'bicep_curls'): {1: [''],
+                            2: ['Focus on fully extending your elbows.', 'Extend your elbows more.'],
+                            3: ['Great work. Can you focus on extending your elbows?', 'Great job. Can you try extending your elbows a bit more?']},
+    ('1c', None): {1: [''],
+                   2: ['Focus on fully extending your arms to 90 degrees.', 'Make sure your arms reach 90 degrees'],
+                   3: ['Great job, try to reach your arms closer to 90 degrees.', 'Nice, can you reach your arms closer to 90 degrees?']},
+    #Right high range of motion
+    ('1d', None): {1: [''],
+                   2: ['Focus on stopping your right arm at 90 degrees.', 'Make sure your right arm is stopping at 90 degrees.'],
+                   3: ['Great work, can you focus on stopping your right arm at 90 degrees?', 'Nice job, can you make sure you are stopping your right arm at 90 degrees']},
+    #Left high range of motion
+    ('1e', None): {1: [''],
+                   2: ['Focus on stopping your left arm at 90 degrees.', 'Make sure your left arm is stopping at 90 degrees.'],
+                   3: ['Great work, can you focus on stopping your right arm at 90 degrees?', 'Nice job, can you make sure you are stopping your left arm at 90 degrees?']},
+    #Both sides high range of motion
+    ('1f', None): {1: [''],
+                   2: ['Focus on stopping your arms at 90 degrees.', 'Make sure your arms is stopping at 90 degrees.'],
+                   3: ['Great work, can you focus on stopping your arms at 90 degrees?', 'Nice job, can you make sure you are stopping your arms at 90 degrees?']},
+    #Right bad
+    ('1g', None): {1: [''],
+                   2: ['Focus on your right side.', 'Pay more attention to your right side.'],
+                   3: ['You are doing great, can you focus a bit more on your right side?', 'You got this, can you focus a bit more on your right side?']},
+    #Left bad
+    ('1h', None): {1: [''],
+                   2: ['Focus on your left side.', 'Pay more attention to your left side.'],
+                   3: ['You are doing great, can you focus a bit more on your left side?', 'You got this, can you focus a bit more on your left side?']},
+    #Generic bad
+    ('1i', 'bicep_curls'): {1: [''],
+                            2: ['Focus on getting a full range of motion in your elbows.', 'Make sure you are getting a full range of motion in your elbows.'],
+                            3: ['You are doing great, try to get a full range of motion in your elbows.', 'You got this, can you focus a bit more on a full range of motion in your elbows?']},
+    ('1i', None): {1: [''],
+                   2: ['Focus on getting a full range of motion in your shoulders.', 'Make sure your arms are getting a full range of motion.'],
+                   3: ['Great work, try to get a full range of motion in your shoulders.', 'Nice job, can you focus a bit more on a full range of motion in your shoulders?']},
+    #2 bad followed by good
+    ('2a', None): {1: [''],
+                   2: ['Form is good, keep it up.', 'Form looks good, keep going.'],
+                   3: ['Looks good, great job!', 'Great work, looking good!']},
+    #4 good - but only every 3 or so
+    ('2b', None): {1: [''],
+                   2: ['Form is good, keep it up.', 'Form looks good, keep going.'],
+                   3: ['Looks good, great job!', 'Great work, looking good!']},
+    #2 fast in a row
+    ('3a', None): {1: [''],
+                   2: ['Try to slow down.', 'Make sure you do not go too fast.'],
+                   3: ['Nice job, can you slow down a little on the next few?', 'Great work, can you try to slow down on the next few?']},
+    #2 slow in a row
+    ('3b', None): {1: [''],
+                   2: ['Try to speed up.', 'Make sure you do not go too slow.'],
+                   3: ['Nice job, can you speed up a little on the next few?', 'Great work, can you try to speed up on the next few?']},
+    #2 bad followed by 1 good speed
+    ('4a', None): {1: [''],
+                   2: ['Good speed, keep it up.', 'Nice speed, keep going.'],
+                   3: ['Great work, nice pace!', 'Nice job, great speed!']},
+    #4 good speed, but only every 3 or so
+    ('4b', None): {1: [''],
+                   2: ['Good speed, keep it up.', 'Nice speed, keep going.'],
+                   3: ['Great work, nice pace!', 'Nice job, great speed!']},
+}
 
 class FeedbackController:
-    def __init__(self, replay, log_filename, robot_num):
+    def __init__(self, replay, log_filename, robot_num, clock=None):
         self.flag = False
         self.replay = replay
-        self.logger = logging.getLogger()
-        formatter = logging.Formatter('%(asctime)s | %(levelname)s | %(message)s')
-        stdout_handler = logging.StreamHandler(sys.stdout)
-        stdout_handler.setLevel(logging.DEBUG)
-        stdout_handler.setFormatter(formatter)
-        self.logger.addHandler(stdout_handler)
+        #Replays pass a VirtualClock driven by the recorded times
+        self.clock = clock if clock is not None else WallClock()
+
+        #Log records and events are written from a background thread
+        if self.replay:
+            self.logger, self.events = setup_logging()
+            #Replayed events are also kept to compare against the live session's log
+            self.event_history = []
+        else:
+            self.set_log_file(log_filename)
+
+        #Text and expected end time of the utterance being played, and quori_sound's queue state.
+        #Replaying, both come from a simulation of the queue on the virtual clock
+        self.speaking = None
+        self.speech_state = None
+        self.simulated_queue = []
+        self.simulated_arrivals = 0
+        self.speech_free_at = 0.0
+
+        #Gesture jitter is drawn from a generator seeded per set, the seed is logged so replays match
+        self.random = np.random.RandomState()
 
         if not self.replay:
             #Initialize the publishers/subscribers
-            self.sound_pub = rospy.Publisher("quori_sound", String, queue_size=10)
+            self.speech_pub = rospy.Publisher('quori_sound/request', SpeechRequest, queue_size=10)
+            self.speech_state_sub = rospy.Subscriber('quori_sound/state', SpeechQueueState, self.speech_state_callback)
+            self.speech_event_sub = rospy.Subscriber('quori_sound/events', SpeechEvent, self.speech_event_callback)
+            self.duration_srv = rospy.ServiceProxy('quori_sound/get_duration', GetSpeechDuration)
             self.movement_pub = rospy.Publisher('quori/joint_trajectory_controller/command', JointTrajectory, queue_size=10)
             self.emotion_pub = rospy.Publisher('quori/face_generator_emotion', Float64MultiArray, queue_size=10)
-        
-            #Add file handler
-            file_handler = logging.FileHandler('src/quori_exercises/saved_logs/{}'.format(log_filename))
-            file_handler.setFormatter(formatter)
-            self.logger.addHandler(file_handler)
+
+        #Gesture keyframes are published from a timer so reacting never blocks the caller. Replaying,
+        #they are only recorded in gesture_log
+        self.behaviors = BehaviorScheduler(clock=self.clock)
+        self.gesture_log = []
         
         self.message_log = []
+        self.message_counts = Counter()
         self.message_time_stamps = []
+        #Playback lengths measured by quori_sound, keyed by text
+        self.durations = {}
         self.eval_case_log = []
         self.speed_case_log = []
         self.robot_num = int(robot_num)
+
+        #Lookup table of options for this robot, keyed by (case, exercise)
+        self.message_table = {key: options[self.robot_num] for key, options in FEEDBACK_MESSAGES.items()}
+        #Syllable fit for the length of phrases quori_sound has not measured (and when replaying)
         self.intercept = 0.6477586140350873
         self.slope = 0.31077594
+        if not self.replay:
+            self.load_durations(sorted(set(m for options in self.message_table.values() for m in options if m != '')))
         
         if robot_num == 1:
             self.neutral_expression = [0.1, 0, 0, 0, 0, 0]
@@ -50,25 +162,138 @@ class FeedbackController:
             self.neutral_expression = [0.3, 0, 0, 0, 0, 0]
             self.neutral_posture = [0.2, -1.1, 0, -1.1, -0.2]
 
-    def start_new_set(self):
+    def set_log_file(self, log_filename):
+        #Text log and JSONL events in saved_logs, can be switched between sets
+        log_path = 'src/quori_exercises/saved_logs/{}'.format(log_filename)
+        self.logger, self.events = setup_logging(log_path, os.path.splitext(log_path)[0] + '.jsonl')
+
+    def start_new_set(self, seed=None):
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.random = np.random.RandomState(seed)
+        self.log_event('set_start', seed=seed)
         self.eval_case_log.append([])
         self.speed_case_log.append([])
-
-    def message(self, m, priority=2):
-        #Only message if it has been 3 sec since last message ended
-        if (len(self.message_time_stamps)) > 0:
-            last_message_time = self.message_time_stamps[-1]
-            if (datetime.now(timezone('EST')) - last_message_time).total_seconds() < 3.5 and priority < 2:
-                #Skip message
+        #Index of the last occurrence of each case in the current set
+        self.last_eval_case = {}
+        self.last_speed_case = {}
+
+    def message(self, m, priority=2, key=''):
+        #Rep feedback is skipped if it could not start in time, from the length of what quori_sound
+        #is playing and has queued (simulated when replaying)
+        if priority < 2:
+            skip = self.speech_busy_until(key) - self.clock.now() > FEEDBACK_TTL
+            if skip:
                 self.logger.info('Skipping {}'.format(m))
-                return
+                self.log_event('message', text=m, priority=priority, key=key, skipped=True)
+                return False
                 
         self.logger.info('Robot says: {}'.format(m))
-        length_estimate = np.round(self.slope*syllables.estimate(m) + self.intercept)
-        if not self.replay:
-            self.sound_pub.publish(m)
+        self.log_event('message', text=m, priority=priority, key=key, skipped=False)
+        #Session messages never expire, rep feedback is dropped once it is stale
+        ttl = FEEDBACK_TTL if priority < 2 else 0
+        if self.replay:
+            self.simulate_request(m, priority, key, ttl)
+        else:
+            request = SpeechRequest(text=m, priority=priority, key=key, ttl=ttl)
+            request.header.stamp = rospy.Time.now()
+            self.speech_pub.publish(request)
         self.message_log.append(m)
-        self.message_time_stamps.append(datetime.now(timezone('EST')) + timedelta(seconds=length_estimate) )
+        self.message_counts[m] += 1
+        self.message_time_stamps.append(self.clock.datetime(timezone('EST')) + timedelta(seconds=self.message_duration(m)))
+        return True
+
+    def message_duration(self, m):
+        if m in self.durations:
+            return self.durations[m]
+        return np.round(self.slope*syllables.estimate(m) + self.intercept)
+
+    def load_durations(self, texts):
+        #Phrases quori_sound has not rendered yet are filled in from its start events
+        try:
+            self.duration_srv.wait_for_service(timeout=2.0)
+            response = self.duration_srv(texts)
+        except (rospy.ROSException, rospy.ServiceException) as e:
+            self.logger.info('Could not get speech durations: {}'.format(e))
+            return
+        for text, duration in zip(texts, response.durations):
+            if duration >= 0:
+                self.durations[text] = duration
+
+    def speech_busy_until(self, key=''):
+        #When quori_sound will be done with the current utterance and the queue, leaving out
+        #anything a message with this key would replace
+        if self.replay:
+            self.advance_speech()
+        end = self.clock.now()
+        if self.speaking is not None:
+            end = max(end, self.speaking[1])
+        for text, pending_key in self.pending_speech():
+            if key == '' or pending_key != key:
+                end += self.message_duration(text)
+        return end
+
+    def pending_speech(self):
+        #(text, key) of everything quori_sound has queued
+        if self.replay:
+            return [(entry[3], entry[4]) for entry in self.simulated_queue]
+        if self.speech_state is None:
+            return []
+        return list(zip(self.speech_state.pending, self.speech_state.pending_keys))
+
+    def simulate_request(self, text, priority, key, ttl):
+        #Replaying, requests go into a copy of quori_sound's queue with the same ordering,
+        #replacement and expiry rules, played for their logged (or estimated) durations
+        now = self.clock.now()
+        self.advance_speech()
+        if key != '':
+            self.simulated_queue = [entry for entry in self.simulated_queue if entry[4] != key]
+        deadline = now + ttl if ttl > 0 else None
+        self.simulated_queue.append((priority, self.simulated_arrivals, deadline, text, key, now))
+        self.simulated_arrivals += 1
+        self.simulated_queue.sort(key=lambda entry: (-entry[0], entry[1]))
+        self.advance_speech()
+
+    def advance_speech(self):
+        #Plays the simulated queue up to the virtual time
+        now = self.clock.now()
+        while True:
+            if self.speaking is not None:
+                if self.speaking[1] > now:
+                    return
+                self.speech_free_at = self.speaking[1]
+                self.speaking = None
+            if len(self.simulated_queue) == 0:
+                return
+
+            priority, arrival, deadline, text, key, stamp = self.simulated_queue.pop(0)
+            start = max(self.speech_free_at, stamp)
+            if deadline is not None and deadline < start:
+                continue
+            self.speaking = (text, start + self.message_duration(text))
+
+    def speech_event_callback(self, event):
+        if event.event == SpeechEvent.START:
+            self.durations[event.text] = event.duration
+            self.speaking = (event.text, event.header.stamp.to_sec() + event.duration)
+        else:
+            self.speaking = None
+            if not event.completed:
+                self.logger.info('Speech cut short after {:.1f} s: {}'.format(event.duration, event.text))
+            self.log_event('speech', text=event.text, key=event.key, duration=event.duration, completed=event.completed)
+
+    def log_event(self, event, **fields):
+        self.events.log(event, stamp=self.clock.now(), **fields)
+        if self.replay:
+            self.event_history.append(dict(fields, time=self.clock.now(), event=event))
+
+    def speech_state_callback(self, state):
+        if self.speech_state is not None and (state.expired > self.speech_state.expired or state.replaced > self.speech_state.replaced):
+            self.logger.info('Speech queue dropped {} expired and {} replaced messages'.format(
+                state.expired - self.speech_state.expired, state.replaced - self.speech_state.replaced))
+        self.log_event('speech_queue', speaking=state.speaking, pending=list(state.pending),
+                       expired=state.expired, replaced=state.replaced)
+        self.speech_state = state
     
     def find_eval_case(self, feedback):
         c = ''
@@ -155,9 +380,8 @@ class FeedbackController:
                 c= '2b'
 
                 #last positive message
-                if '2b' in self.eval_case_log[-1]:
-                    # finding the last occurrence
-                    final_index = max([index for index, item in enumerate(self.eval_case_log[-1]) if item == '2b'])
+                if '2b' in self.last_eval_case:
+                    final_index = self.last_eval_case['2b']
                     if final_index + 3 >= len(self.eval_case_log[-1]):
                        c= ''
         # print(c)
@@ -187,171 +411,19 @@ class FeedbackController:
                 c= '4b'
 
                 #last positive message
-                if '4b' in self.speed_case_log[-1]:
-                    # finding the last occurrence
-                    final_index = max([index for index, item in enumerate(self.speed_case_log[-1]) if item == '4b'])
+                if '4b' in self.last_speed_case:
+                    final_index = self.last_speed_case['4b']
                     if final_index + 3 >= len(self.speed_case_log[-1]):
                        c= ''
         
         return c
 
     def get_message(self, c, exercise_name):
+        #Exercise specific options first, then the ones shared by every exercise
+        options = self.message_table.get((c, exercise_name), self.message_table.get((c, None), ['']))
 
-        if c == '1a': #Right low range of motion
-            if exercise_name == 'bicep_curls':
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on fully extending your right elbow.', 'Extend your right elbow more.']
-                elif self.robot_num == 3:
-                    options = ['Great work. Can you focus on extending your right elbow?', 'Great job. Can you try extending your right elbow a bit more?']
-            else:
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on fully extending your right arm to 90 degrees.', 'Make sure your right arm reaches 90 degrees']
-                elif self.robot_num == 3:
-                    options = ['Great job, try to reach your right arm closer to 90 degrees.', 'Nice, can you reach your right arm closer to 90 degrees?']
-        elif c == '1b': #Left low range of motion
-            if exercise_name == 'bicep_curls':
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on fully extending your left elbow.', 'Extend your left elbow more.']
-                elif self.robot_num == 3:
-                    options = ['Great work. Can you focus on extending your left elbow?', 'Great job. Can you try extending your left elbow a bit more?']
-            else:
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on fully extending your left arm to 90 degrees.', 'Make sure your left arm reaches 90 degrees']
-                elif self.robot_num == 3:
-                    options = ['Great job, try to reach your left arm closer to 90 degrees.', 'Nice, can you reach your left arm closer to 90 degrees?']
-        elif c == '1c': #Both sides low range of motion
-            if exercise_name == 'bicep_curls':
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on fully extending your elbows.', 'Extend your elbows more.']
-                elif self.robot_num == 3:
-                    options = ['Great work. Can you focus on extending your elbows?', 'Great job. Can you try extending your elbows a bit more?']
-            else:
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on fully extending your arms to 90 degrees.', 'Make sure your arms reach 90 degrees']
-                elif self.robot_num == 3:
-                    options = ['Great job, try to reach your arms closer to 90 degrees.', 'Nice, can you reach your arms closer to 90 degrees?']
-        elif c == '1d': #Right high range of motion
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on stopping your right arm at 90 degrees.', 'Make sure your right arm is stopping at 90 degrees.']
-                elif self.robot_num == 3:
-                    options = ['Great work, can you focus on stopping your right arm at 90 degrees?', 'Nice job, can you make sure you are stopping your right arm at 90 degrees']
-        elif c == '1e': #Left high range of motion
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on stopping your left arm at 90 degrees.', 'Make sure your left arm is stopping at 90 degrees.']
-                elif self.robot_num == 3:
-                    options = ['Great work, can you focus on stopping your right arm at 90 degrees?', 'Nice job, can you make sure you are stopping your left arm at 90 degrees?']
-        elif c == '1f': #Both sides high range of motion
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on stopping your arms at 90 degrees.', 'Make sure your arms is stopping at 90 degrees.']
-                elif self.robot_num == 3:
-                    options = ['Great work, can you focus on stopping your arms at 90 degrees?', 'Nice job, can you make sure you are stopping your arms at 90 degrees?']
-        elif c == '1g': #Right bad
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Focus on your right side.', 'Pay more attention to your right side.']
-            elif self.robot_num == 3:
-                options = ['You are doing great, can you focus a bit more on your right side?', 'You got this, can you focus a bit more on your right side?']
-        elif c == '1h': #Left bad
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Focus on your left side.', 'Pay more attention to your left side.']
-            elif self.robot_num == 3:
-                options = ['You are doing great, can you focus a bit more on your left side?', 'You got this, can you focus a bit more on your left side?']
-        elif c == '1i': #generic bad
-            if exercise_name == 'bicep_curls':
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on getting a full range of motion in your elbows.', 'Make sure you are getting a full range of motion in your elbows.']
-                elif self.robot_num == 3:
-                    options = ['You are doing great, try to get a full range of motion in your elbows.', 'You got this, can you focus a bit more on a full range of motion in your elbows?']
-            else:
-                if self.robot_num == 1:
-                    options = ['']
-                elif self.robot_num == 2:
-                    options = ['Focus on getting a full range of motion in your shoulders.', 'Make sure your arms are getting a full range of motion.']
-                elif self.robot_num == 3:
-                    options = ['Great work, try to get a full range of motion in your shoulders.', 'Nice job, can you focus a bit more on a full range of motion in your shoulders?']
-        elif c == '2a': #2 bad followed by good
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Form is good, keep it up.', 'Form looks good, keep going.']
-            elif self.robot_num == 3:
-                options = ['Looks good, great job!', 'Great work, looking good!']
-        elif c == '2b': #4 good - but only every 3 or so
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Form is good, keep it up.', 'Form looks good, keep going.']
-            elif self.robot_num == 3:
-                options = ['Looks good, great job!', 'Great work, looking good!']
-        elif c == '3a': #2 fast in a row
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Try to slow down.', 'Make sure you do not go too fast.']
-            elif self.robot_num == 3:
-                options = ['Nice job, can you slow down a little on the next few?', 'Great work, can you try to slow down on the next few?']
-        elif c == '3b': #2 slow in a row
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Try to speed up.', 'Make sure you do not go too slow.']
-            elif self.robot_num == 3:
-                options = ['Nice job, can you speed up a little on the next few?', 'Great work, can you try to speed up on the next few?']
-        elif c == '4a': #2 bad followed by 1 good speed
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Good speed, keep it up.', 'Nice speed, keep going.']
-            elif self.robot_num == 3:
-                options = ['Great work, nice pace!', 'Nice job, great speed!']
-        elif c == '4b': #4 good speed, but only every 3 or so
-            if self.robot_num == 1:
-                options = ['']
-            elif self.robot_num == 2:
-                options = ['Good speed, keep it up.', 'Nice speed, keep going.']
-            elif self.robot_num == 3:
-                options = ['Great work, nice pace!', 'Nice job, great speed!']
-        else:
-            options = ['']
-
-        if len(options) > 0:
-            #Pick the option that has been chosen the least
-            counts = []
-            for option in options:
-                if option in self.message_log:
-                    counts.append(self.message_log.count(option))
-                else:
-                    counts.append(0)
-            
-            #Get the minimum count
-            ind = np.argmin(counts)
-            
-            return options[ind]
-
-        return ''
+        #Pick the option that has been chosen the least (first one on ties)
+        return min(options, key=lambda option: self.message_counts[option])
 
     def move_right_arm(self, start, end):
 
@@ -368,63 +440,66 @@ class FeedbackController:
         
         self.logger.info('Moving arm from {} to {}'.format(start, end))
         
-        self.send_body(positions[start], positions[end], 4)
+        #Session scripts rely on the arm being in place before they continue
+        self.send_body(positions[start], positions[end], 4, block=True)
 
-    def change_expression(self, expression, intensity, duration):
+    def change_expression(self, expression, intensity, duration, block=True, delay=0, preempt=False):
         #['joy', 'sadness', 'anger', 'disgust', 'fear', 'surprise']
         if expression == 'smile':
-            if not self.replay:
-                self.send_expression([intensity, 0, 0, 0, 0, 0], self.neutral_expression, duration)
+            self.send_expression([intensity, 0, 0, 0, 0, 0], self.neutral_expression, duration, block, delay, preempt)
             self.logger.info('Robot smiling at intensity {} for duration {}'.format(intensity, duration))
         elif expression == 'frown':
-            if not self.replay:
-                self.send_expression([0, intensity, 0, 0, 0, 0], self.neutral_expression, duration)
+            self.send_expression([0, intensity, 0, 0, 0, 0], self.neutral_expression, duration, block, delay, preempt)
             self.logger.info('Robot frowning at intensity {} for duration {}'.format(intensity, duration))
 
-    def send_expression(self, start_emotion, end_emotion, duration):
-        emotion_to_send = Float64MultiArray()
-        emotion_to_send.data = start_emotion
-        self.emotion_pub.publish(emotion_to_send)
-
-        time.sleep(duration/2)
+    def send_expression(self, start_emotion, end_emotion, duration, block=False, delay=0, preempt=False):
+        keyframes = []
+        for offset, emotion in [(0, start_emotion), (duration/2, end_emotion)]:
+            emotion_to_send = Float64MultiArray()
+            emotion_to_send.data = emotion
+            keyframes.append((offset, self.publish_expression, emotion_to_send))
 
-        emotion_to_send = Float64MultiArray()
-        emotion_to_send.data = end_emotion
-        self.emotion_pub.publish(emotion_to_send)
+        self.behaviors.schedule('face', keyframes, preempt=preempt, delay=delay)
+        if block:
+            self.behaviors.wait('face')
 
-    def send_body(self, start_position, end_position, duration):
+    def send_body(self, start_position, end_position, duration, block=False, delay=0, preempt=False):
         self.logger.info('Moving from {} to {} for duration {}'.format(start_position, end_position, duration))
-        if not self.replay:
-            # print('Start: {}, End: {}, Duration {}'.format(start_position, end_position, duration))
-            #Start point
+        #Start point, then end point halfway through
+        keyframes = []
+        for offset, position in [(0, start_position), (duration/2, end_position)]:
             traj = JointTrajectory()
             traj.joint_names = ["r_shoulder_pitch", "r_shoulder_roll", "l_shoulder_pitch", "l_shoulder_roll", "waist_pitch"]
-            point_1 = JointTrajectoryPoint()
-            point_1.time_from_start = rospy.Duration(duration / 2)
-            point_1.positions = start_position
-            traj.points=[point_1]
+            point = JointTrajectoryPoint()
+            point.time_from_start = rospy.Duration(duration / 2)
+            point.positions = list(position)
+            traj.points=[point]
+            keyframes.append((offset, self.publish_body, traj))
+
+        self.behaviors.schedule('body', keyframes, preempt=preempt, delay=delay)
+        if block:
+            self.behaviors.wait('body')
+
+    def publish_body(self, traj):
+        self.gesture_log.append((self.clock.now(), 'body', list(traj.points[0].positions)))
+        if not self.replay:
             self.movement_pub.publish(traj)
 
-            time.sleep(duration/2)
-
-            #End point
-            traj = JointTrajectory()
-            traj.joint_names = ["r_shoulder_pitch", "r_shoulder_roll", "l_shoulder_pitch", "l_shoulder_roll", "waist_pitch"]
-
-            point_2 = JointTrajectoryPoint()
-            point_2.time_from_start = rospy.Duration(duration / 2)
-            point_2.positions = end_position
-            traj.points=[point_2]
-            self.movement_pub.publish(traj)
+    def publish_expression(self, emotion):
+        self.gesture_log.append((self.clock.now(), 'face', list(emotion.data)))
+        if not self.replay:
+            self.emotion_pub.publish(emotion)
     
     def react_nonverbal(self, c):
-        #Choose movement based on case
+        #Choose movement based on case. Reactions replace a previous reaction that has not
+        #played yet, but never posture moves queued by the session
+        start_position, end_position, expression = None, None, None
         if c == '' or self.robot_num == 1:
             a = -0.1
             b = 0.1
-            start_position = (self.neutral_posture + (b-a) * np.random.random_sample((5,)) + a).tolist()
-            end_position = (self.neutral_posture + (b-a) * np.random.random_sample((5,)) + a).tolist()
-            self.send_body(start_position, end_position, 2)
+            start_position = (self.neutral_posture + (b-a) * self.random.random_sample((5,)) + a).tolist()
+            end_position = (self.neutral_posture + (b-a) * self.random.random_sample((5,)) + a).tolist()
+            self.send_body(start_position, end_position, 2, preempt=True)
 
         else:
             #We have a case
@@ -445,12 +520,13 @@ class FeedbackController:
                     torso = 0.21*0.4
                 
                 start_position = [end_arm[0], end_arm[1], end_arm[0], end_arm[1], torso]
-                self.send_body(start_position, end_position, 4)
+                self.send_body(start_position, end_position, 4, preempt=True)
 
+                #Expression follows once the body reaches its first keyframe
                 if self.robot_num == 2:
-                    self.change_expression('smile', 0.6, 4)
+                    expression = ('smile', 0.6)
                 elif self.robot_num == 3:
-                    self.change_expression('smile', 0.9, 4)
+                    expression = ('smile', 0.9)
 
             #Negative cases
             if c in ['1a', '1b', '1c', '1d', '1e', '1f', '1g', '1h', '1i', '3a', '3b']:
@@ -466,19 +542,27 @@ class FeedbackController:
 
                 start_position = self.neutral_posture
                 start_position[-1] = torso
-                self.send_body(start_position, end_position, 4)
+                self.send_body(start_position, end_position, 4, preempt=True)
 
                 if self.robot_num == 2:
-                    self.change_expression('frown', 0.5, 4)
+                    expression = ('frown', 0.5)
                 elif self.robot_num == 3:
-                    self.change_expression('frown', 0.0, 4)
+                    expression = ('frown', 0.0)
+
+            if expression is not None:
+                self.change_expression(expression[0], expression[1], 4, block=False, delay=2, preempt=True)
+
+        self.log_event('gesture', case=c, start=list(start_position) if start_position is not None else None,
+                       end=list(end_position) if end_position is not None else None, expression=expression)
      
     def react(self, feedback, exercise_name): 
         
         eval_case = self.find_eval_case(feedback)
+        self.last_eval_case[eval_case] = len(self.eval_case_log[-1])
         self.eval_case_log[-1].append(eval_case)
 
         speed_case = self.find_speed_case(feedback)
+        self.last_speed_case[speed_case] = len(self.speed_case_log[-1])
         self.speed_case_log[-1].append(speed_case)
 
         #Get message for each case
@@ -487,19 +571,29 @@ class FeedbackController:
 
         self.logger.info('Evaluation case {} with message - {}'.format(eval_case, eval_message))
         self.logger.info('Speed case {} with message - {}'.format(speed_case, speed_message))
+        self.log_event('cases', exercise=exercise_name, rep=len(feedback), eval_case=eval_case, speed_case=speed_case,
+                       eval_message=eval_message, speed_message=speed_message)
         
         #If both messages available, choose the eval message
+        #said is whatever was not skipped
+        said = ''
         if speed_message == '' and not eval_message == '':
-            self.message(eval_message, priority=1)
+            if self.message(eval_message, priority=1, key=eval_case):
+                said = eval_message
             self.react_nonverbal(eval_case)
         elif not speed_message == '' and eval_message == '':
-            self.message(speed_message, priority=1)
+            if self.message(speed_message, priority=1, key=speed_case):
+                said = speed_message
             self.react_nonverbal(speed_case)
         elif not speed_message == '' and not eval_message == '':
-            self.message(eval_message, priority=1)
+            if self.message(eval_message, priority=1, key=eval_case):
+                said = eval_message
             self.react_nonverbal(eval_case)
         else:
             self.react_nonverbal('')
+
+        return {'eval_case': eval_case, 'speed_case': speed_case, 'eval_message': eval_message,
+                'speed_message': speed_message, 'message': said}
         
         
             
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import numpy as np
+
+#Shared by live tracking (pose_tracking.py) and offline extraction (extract_video_poses.py)
+LANDMARK_POINTS = ['nose', 'left_eye_inner', 'left_eye', 'left_eye_outer', 'right_eye_inner', 'right_eye', 'right_eye_outer', 'left_ear', 'right_ear', 'mouth_left', 'mouth_right', 'left_shoulder', 'right_shoulder', 'left_elbow', 'right_elbow', 'left_wrist', 'right_wrist', 'left_pinky', 'right_pinky', 'left_index', 'right_index', 'left_thumb', 'right_thumb', 'left_hip', 'right_hip', 'left_knee', 'right_knee', 'left_ankle', 'right_ankle', 'left_heel', 'right_heel', 'left_foot_index', 'right_foot_index']
+
+JOINTS = [['right_hip', 'right_shoulder', 'right_elbow', 'xy', 'right shoulder'],
+            ['left_hip', 'left_shoulder', 'left_elbow', 'xy', 'left shoulder'],
+            ['right_hip', 'right_shoulder', 'right_elbow', 'yz', 'right shoulder'],
+            ['left_hip', 'left_shoulder', 'left_elbow', 'yz', 'left shoulder'],
+            ['right_hip', 'right_shoulder', 'right_elbow', 'xz', 'right shoulder'],
+            ['left_hip', 'left_shoulder', 'left_elbow', 'xz', 'left shoulder'],
+            ['right_shoulder', 'right_elbow', 'right_wrist', 'xy', 'right elbow'],
+            ['left_shoulder', 'left_elbow', 'left_wrist', 'xy', 'left elbow'],
+            ['right_shoulder', 'right_elbow', 'right_wrist', 'xz', 'right elbow'],
+            ['left_shoulder', 'left_elbow', 'left_wrist', 'xz', 'left elbow'],
+            ['right_shoulder', 'right_elbow', 'right_wrist', 'yz', 'right elbow'],
+            ['left_shoulder', 'left_elbow', 'left_wrist', 'yz', 'left elbow']]
+
+#Landmark indices of each joint, looked up once
+JOINT_INDICES = [[LANDMARK_POINTS.index(joint[i]) for i in range(3)] for joint in JOINTS]
+
+#MediaPipe pose configuration used everywhere angles are computed
+POSE_CONFIG = {'min_detection_confidence': 0.5,  # have some confidence baseline
+               'min_tracking_confidence': 0.5,
+               'model_complexity': 0}
+
+def calc_angle(vec_0, vec_1, angle_type):
+    if angle_type == 'xy':
+        angle = np.arctan2(vec_1[1], vec_1[1]) - \
+            np.arctan2(-vec_0[1], vec_0[0])
+    elif angle_type == 'yz':
+        angle = np.arctan2(vec_1[1], vec_1[2]) - \
+            np.arctan2(-vec_0[1], -vec_0[2])
+    elif angle_type == 'xz':
+        angle = np.arctan2(vec_1[2], vec_1[0]) - \
+            np.arctan2(-vec_0[2], -vec_0[0])
+
+    angle = np.abs(angle*180.0/np.pi)
+    if angle > 180:
+        angle = 360-angle
+
+    return 180 - angle
+
+def calc_angles(landmarks):
+    #landmarks is a (33, 3) array of x, y, z
+    landmarks = np.asarray(landmarks)
+    angles = []
+    for joint, indices in zip(JOINTS, JOINT_INDICES):
+        points = landmarks[indices]
+
+        vec_0 = points[0] - points[1]
+        vec_1 = points[2] - points[1]
+
+        angles.append(calc_angle(vec_0, vec_1, joint[3]))
+    return angles
+
+def landmarks_to_array(pose_landmarks):
+    return np.array([[landmark.x, landmark.y, landmark.z] for landmark in pose_landmarks.landmark])
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+from collections import deque
+import numpy as np
+
+#Quality levels from cheapest to most accurate: (MediaPipe model_complexity, inference width in pixels, 0 = full frame)
+DEFAULT_LEVELS = [(0, 192), (0, 256), (0, 0), (1, 256), (1, 0)]
+
+class PoseGovernor:
+
+    def __init__(self, budget, levels=DEFAULT_LEVELS, start_level=1, window=30, headroom=0.6, hold_windows=10):
+        #budget is the per-frame inference time (s) we want to stay under
+        self.budget = budget
+        self.levels = levels
+        self.level = start_level
+        self.latencies = deque(maxlen=window)
+        self.headroom = headroom
+        self.hold_windows = hold_windows
+        #After stepping down, wait this many windows before trying to step up again
+        self.hold = 0
+        self.last_change = ''
+
+    @property
+    def model_complexity(self):
+        return self.levels[self.level][0]
+
+    @property
+    def inference_width(self):
+        return self.levels[self.level][1]
+
+    def update(self, latency):
+        #Returns True when the level changed, the reason is kept in last_change
+        self.latencies.append(latency)
+        if len(self.latencies) < self.latencies.maxlen:
+            return False
+
+        #90th percentile so occasional slow frames count, but a single spike does not
+        observed = np.percentile(self.latencies, 90)
+        self.latencies.clear()
+        if self.hold > 0:
+            self.hold -= 1
+
+        if observed > self.budget and self.level > 0:
+            self.level -= 1
+            self.hold = self.hold_windows
+            reason = 'over'
+        elif observed < self.budget*self.headroom and self.level < len(self.levels) - 1 and self.hold == 0:
+            self.level += 1
+            reason = 'under'
+        else:
+            return False
+
+        self.last_change = 'p90 latency {:.1f} ms {} budget {:.1f} ms, switching to model_complexity {} at width {}'.format(
+            1000*observed, reason, 1000*self.budget, self.model_complexity, self.inference_width or 'full')
+        return True
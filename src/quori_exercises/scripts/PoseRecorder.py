@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import os
+import glob
+import threading
+from datetime import datetime
+import numpy as np
+from numpy.lib.format import open_memmap
+
+class PoseRecorder:
+
+    def __init__(self, directory, landmark_points, joints, chunk_size=1800, flush_every=30):
+        #Frames are streamed into preallocated .npy chunks, so memory stays flat and
+        #everything written before a crash can still be read back with load_recording
+        self.directory = directory
+        self.num_landmarks = len(landmark_points)
+        self.num_angles = len(joints)
+        self.chunk_size = chunk_size
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        np.savez(os.path.join(directory, 'meta.npz'),
+                 landmark_points=np.array(landmark_points),
+                 joints=np.array(joints))
+
+        self.chunk_index = -1
+        self.row = 0
+        self.landmarks = None
+        self.angles = None
+        self.times = None
+        self.new_chunk()
+
+    def new_chunk(self):
+        self.flush()
+        self.chunk_index += 1
+        prefix = os.path.join(self.directory, 'chunk_{:04d}_'.format(self.chunk_index))
+
+        self.landmarks = open_memmap(prefix + 'landmarks.npy', mode='w+', dtype=np.float64,
+                                     shape=(self.chunk_size, self.num_landmarks, 3))
+        self.angles = open_memmap(prefix + 'angles.npy', mode='w+', dtype=np.float64,
+                                  shape=(self.chunk_size, self.num_angles))
+        #NaN marks rows that were never written
+        self.times = open_memmap(prefix + 'times.npy', mode='w+', dtype=np.float64,
+                                 shape=(self.chunk_size,))
+        self.times[:] = np.nan
+        self.row = 0
+
+    def append(self, time, landmarks, angles):
+        with self.lock:
+            if self.closed:
+                return
+            if self.row == self.chunk_size:
+                self.new_chunk()
+
+            self.landmarks[self.row] = landmarks
+            self.angles[self.row] = angles
+            #Time is written last so a row only counts once it is complete
+            self.times[self.row] = time.timestamp()
+            self.row += 1
+
+            if self.row % self.flush_every == 0:
+                self.flush()
+
+    def flush(self):
+        for array in [self.landmarks, self.angles, self.times]:
+            if array is not None:
+                array.flush()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.closed = True
+
+
+def load_recording(directory, tz=None):
+    meta = np.load(os.path.join(directory, 'meta.npz'))
+    landmarks = []
+    angles = []
+    times = []
+    for times_file in sorted(glob.glob(os.path.join(directory, 'chunk_*_times.npy'))):
+        prefix = times_file[:-len('times.npy')]
+        chunk_times = np.load(times_file, mmap_mode='r')
+        valid = ~np.isnan(chunk_times)
+
+        times.append(chunk_times[valid])
+        landmarks.append(np.load(prefix + 'landmarks.npy', mmap_mode='r')[valid])
+        angles.append(np.load(prefix + 'angles.npy', mmap_mode='r')[valid])
+
+    times = np.concatenate(times)
+    return {'landmarks': np.concatenate(landmarks),
+            'times': np.array([datetime.fromtimestamp(t, tz) for t in times]),
+            'angles': np.concatenate(angles),
+            'landmark_points': meta['landmark_points'],
+            'joints': meta['joints']}
+
+
+def save_npz(directory, filename, tz=None):
+    #Same layout as the original recording mode, which create_experts.py reads
+    recording = load_recording(directory, tz)
+    np.savez(filename, **recording)
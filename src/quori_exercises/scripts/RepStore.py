@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import os
+import numpy as np
+
+#Per-rep results as columns, one .npy file per column in a directory per session, so analyses
+#across many sessions only read the columns they need and never unpickle anything:
+#  saved_data/reps/Participant_1_Robot_3/exercise.npy, .../distance_good.npy, ...
+#There is one row per rep and joint group, rep fields are repeated for each group
+COLUMNS = {'participant': str,
+           'robot': int,
+           #Session round, 0 when unknown
+           'round': int,
+           'exercise': str,
+           'set': int,
+           #Rep number in the set (from 1), frame indices of the peaks around it and the time of the first one
+           'rep': int,
+           'start': int,
+           'end': int,
+           'start_time': float,
+           'duration': float,
+           'speed': str,
+           'group': str,
+           #Distance to the closest good expert and to the closest expert, its index and label
+           'distance_good': float,
+           'distance_all': float,
+           'expert': int,
+           'label': str,
+           'correction': str,
+           'evaluation': int,
+           #Feedback cases and messages for the rep, message is the one the robot said
+           'eval_case': str,
+           'speed_case': str,
+           'eval_message': str,
+           'speed_message': str,
+           'message': str}
+
+def to_column(name, values):
+    if COLUMNS[name] is str:
+        #Fixed width unicode, loads without pickle
+        return np.array([str(v) for v in values], dtype=str)
+    return np.array(values, dtype=COLUMNS[name])
+
+class RepStore:
+
+    def __init__(self, directory, **session):
+        #session holds values that are the same for every row (participant, robot, ...) and
+        #take precedence over the ones appended
+        self.directory = directory
+        self.session = session
+        self.columns = {name: [] for name in COLUMNS}
+
+    def append(self, **row):
+        row.update(self.session)
+        for name, values in self.columns.items():
+            values.append(row.get(name, COLUMNS[name]()))
+
+    def __len__(self):
+        return len(self.columns['rep'])
+
+    def arrays(self):
+        return {name: to_column(name, values) for name, values in self.columns.items()}
+
+    def flush(self):
+        #Columns are rewritten whole, a session is a few hundred rows
+        os.makedirs(self.directory, exist_ok=True)
+        for name, column in self.arrays().items():
+            path = os.path.join(self.directory, name + '.npy')
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, column)
+            os.replace(path + '.tmp', path)
+
+def column_mask(column, value):
+    #value can be a single value, a list of values or a function of the column
+    if callable(value):
+        return np.asarray(value(column), dtype=bool)
+    if isinstance(value, (list, tuple, set, np.ndarray)):
+        return np.isin(column, list(value))
+    return column == value
+
+def sessions(root):
+    return sorted([os.path.join(root, name) for name in os.listdir(root) if os.path.exists(os.path.join(root, name, 'rep.npy'))])
+
+def query(root, columns=None, **filters):
+    #Rows from every session under root that match all filters, as a dict of column arrays:
+    #  query('src/quori_exercises/saved_data/reps', ['distance_good'], exercise='bicep_curls', robot=[2, 3])
+    columns = list(COLUMNS) if columns is None else columns
+    unknown = set(columns).union(filters) - set(COLUMNS)
+    if len(unknown) > 0:
+        raise ValueError('Unknown columns {}'.format(sorted(unknown)))
+
+    parts = {name: [] for name in columns}
+    for directory in sessions(root):
+        #Filter columns are read first, the rest only for sessions with matching rows
+        mask = None
+        for name, value in filters.items():
+            column_match = column_mask(np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'), value)
+            mask = column_match if mask is None else mask & column_match
+        if mask is not None and not mask.any():
+            continue
+
+        for name in columns:
+            column = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+            parts[name].append(np.array(column if mask is None else column[mask]))
+
+    return {name: np.concatenate(values) if len(values) > 0 else to_column(name, []) for name, values in parts.items()}
+
+if __name__ == '__main__':
+    #Round trip check: rows written by a store come back unchanged through query
+    import tempfile
+    root = tempfile.mkdtemp()
+    store = RepStore(os.path.join(root, 'Participant_test_Robot_3'), participant='test', robot=3)
+    for rep, group, correction in [(1, 'right shoulder', 'Good'), (1, 'left elbow', 'low range of motion'), (2, 'right shoulder', 'bad')]:
+        store.append(exercise='bicep_curls', set=1, rep=rep, group=group, correction=correction, distance_good=1.5)
+    store.flush()
+
+    rows = query(root, ['rep', 'group', 'correction'], correction='low range of motion')
+    assert list(rows['rep']) == [1] and list(rows['group']) == ['left elbow'], rows
+    rows = query(root, ['correction'], robot=3, exercise='bicep_curls')
+    assert list(rows['correction']) == ['Good', 'low range of motion', 'bad'], rows
+    assert len(query(root, participant='other')['rep']) == 0
+    print('RepStore round trip ok')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import numpy as np
+
+from EventLog import to_json
+
+#Every npz under saved_data/ and experts/ unpacked once into plain .npy files in a cache, so
+#analyses memory-map what they use instead of unpickling whole files. Per-set arrays (angles,
+#peaks, times) are concatenated over the sets of a file with an offsets array next to them,
+#times as seconds since the epoch. Run from the workspace root like the session scripts:
+#  dataset = SessionDataset()
+#  for recording, set_num in dataset.sets(robot=3, exercise='bicep_curls'):
+#      angles = recording.set(set_num)['angles']
+ROOTS = ['src/quori_exercises/saved_data', 'src/quori_exercises/experts']
+CACHE_DIR = 'src/quori_exercises/saved_data/.dataset'
+
+#Arrays with one entry per set, or one per template for the experts
+SET_KEYS = ['angles', 'peaks', 'times', 'landmarks']
+
+def to_float_times(values):
+    return np.array([t.timestamp() if hasattr(t, 'timestamp') else t for t in values], dtype=float)
+
+def to_set_array(key, value):
+    if key == 'times':
+        return to_float_times(value)
+    if key == 'peaks':
+        return np.array(value, dtype=int)
+    return np.asarray(value, dtype=float)
+
+def save_ragged(directory, key, parts):
+    #One array for every part plus where each part starts and ends
+    offsets = np.cumsum([0] + [len(part) for part in parts])
+    non_empty = [part for part in parts if len(part) > 0]
+    array = np.concatenate(non_empty) if len(non_empty) > 0 else np.array(parts[0] if len(parts) > 0 else [])
+    np.save(os.path.join(directory, key + '.npy'), array)
+    np.save(os.path.join(directory, key + '_offsets.npy'), offsets)
+
+def file_info(path):
+    #Participant, round and robot from the session file names
+    name = os.path.basename(path)
+    info = {}
+    for field, pattern in [('participant', r'Participant_([^_]+)'), ('round', r'Round_(\d+)'), ('robot', r'Robot_(\d+)')]:
+        match = re.search(pattern, name)
+        info[field] = (match.group(1) if field == 'participant' else int(match.group(1))) if match is not None else None
+    return info
+
+def unpack(path, directory):
+    #Writes the npz at path into directory, returns its index entry
+    os.makedirs(directory, exist_ok=True)
+    npzfile = np.load(path, allow_pickle=True)
+    entry = file_info(path)
+    entry['keys'] = {}
+
+    if 'exercise_names' in npzfile.files:
+        #Whole session, one entry per set
+        entry['kind'] = 'session'
+        exercise_names = [str(name) for name in npzfile['exercise_names']]
+        per_set = lambda value: list(value)
+    elif 'experts' in npzfile.files:
+        entry['kind'] = 'experts'
+        exercise_names = [os.path.basename(path).split('_experts')[0]]
+        per_set = None
+    else:
+        #A single set (study1 files, demos)
+        entry['kind'] = 'set' if 'exercise_name' in npzfile.files else 'demos'
+        exercise_names = [str(npzfile['exercise_name']) if 'exercise_name' in npzfile.files else os.path.basename(path).split('_demos')[0]]
+        per_set = lambda value: [value]
+
+    for key in npzfile.files:
+        value = npzfile[key]
+        if key == 'experts':
+            save_ragged(directory, key, [np.asarray(expert, dtype=float) for expert in value])
+            entry['keys'][key] = 'ragged'
+        elif key in SET_KEYS and per_set is not None:
+            save_ragged(directory, key, [to_set_array(key, part) for part in per_set(value)])
+            entry['keys'][key] = 'ragged'
+        elif value.dtype != object:
+            np.save(os.path.join(directory, key + '.npy'), value)
+            entry['keys'][key] = 'array'
+        else:
+            #Feedback dicts and anything else pickled, read only when asked for
+            with open(os.path.join(directory, key + '.json'), 'w') as f:
+                json.dump(value.tolist(), f, default=to_json)
+            entry['keys'][key] = 'json'
+
+    entry['exercise_names'] = exercise_names
+    entry['num_sets'] = len(exercise_names)
+    return entry
+
+
+class Recording:
+
+    def __init__(self, name, entry, directory):
+        self.name = name
+        self.entry = entry
+        self.directory = directory
+        self.arrays = {}
+        self.kind = entry['kind']
+        self.participant = entry['participant']
+        self.robot = entry['robot']
+        self.round = entry['round']
+        self.exercise_names = entry['exercise_names']
+        self.num_sets = entry['num_sets']
+
+    def keys(self):
+        return list(self.entry['keys'])
+
+    def array(self, key):
+        #Memory-mapped, opened on first use
+        if key not in self.arrays:
+            kind = self.entry['keys'][key]
+            if kind == 'json':
+                with open(os.path.join(self.directory, key + '.json')) as f:
+                    self.arrays[key] = json.load(f)
+            else:
+                self.arrays[key] = np.load(os.path.join(self.directory, key + '.npy'), mmap_mode='r')
+        return self.arrays[key]
+
+    def part(self, key, ind):
+        #Set (or expert template) ind of a ragged key, a view into the memory map
+        if self.entry['keys'][key] != 'ragged':
+            return self.array(key)
+        if key + '_offsets' not in self.arrays:
+            self.arrays[key + '_offsets'] = np.load(os.path.join(self.directory, key + '_offsets.npy'))
+        offsets = self.arrays[key + '_offsets']
+        return self.array(key)[offsets[ind]:offsets[ind+1]]
+
+    def set(self, set_num):
+        #angles, peaks and times of one set (from 0)
+        data = {'exercise_name': self.entry['exercise_names'][set_num]}
+        for key in SET_KEYS:
+            if key in self.entry['keys']:
+                data[key] = self.part(key, set_num)
+        return data
+
+
+class SessionDataset:
+
+    def __init__(self, roots=ROOTS, cache_dir=CACHE_DIR):
+        self.roots = roots
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.refresh()
+
+    def refresh(self):
+        #Unpacks files that are new or changed since they were indexed, drops ones that are gone
+        found = {}
+        for root in self.roots:
+            if not os.path.isdir(root):
+                continue
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != self.cache_dir]
+                for filename in filenames:
+                    if filename.endswith('.npz'):
+                        path = os.path.join(dirpath, filename)
+                        found[os.path.relpath(path, os.path.dirname(root))[:-len('.npz')]] = path
+
+        changed = False
+        for name, path in found.items():
+            stat = os.stat(path)
+            entry = self.index.get(name)
+            if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                continue
+            entry = unpack(path, self.directory(name))
+            entry.update({'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size})
+            self.index[name] = entry
+            changed = True
+
+        for name in set(self.index) - set(found):
+            del self.index[name]
+            changed = True
+
+        if changed:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump(self.index, f)
+            os.replace(self.index_path + '.tmp', self.index_path)
+
+    def directory(self, name):
+        return os.path.join(self.cache_dir, name.replace(os.sep, '__'))
+
+    def recording(self, name):
+        #By name without .npz, relative to the roots' parent: 'saved_data/Participant_1_Robot_3'
+        return Recording(name, self.index[name], self.directory(name))
+
+    def recordings(self, kind=None, participant=None, robot=None, round=None, exercise=None):
+        matches = []
+        for name in sorted(self.index):
+            entry = self.index[name]
+            if (kind is None or entry['kind'] == kind) and (participant is None or entry['participant'] == participant) \
+                    and (robot is None or entry['robot'] == robot) and (round is None or entry['round'] == round) \
+                    and (exercise is None or exercise in entry['exercise_names']):
+                matches.append(self.recording(name))
+        return matches
+
+    def sets(self, exercise=None, **filters):
+        #(recording, set number) for every recorded set, from session and single set files
+        for recording in self.recordings(exercise=exercise, **filters):
+            if recording.kind not in ('session', 'set'):
+                continue
+            for set_num, exercise_name in enumerate(recording.exercise_names):
+                if exercise is None or exercise_name == exercise:
+                    yield recording, set_num
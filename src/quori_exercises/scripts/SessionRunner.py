@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+import threading
+import numpy as np
+import rospy
+import smach
+
+from ExerciseEval import ExerciseEval
+from FeedbackController import FeedbackController
+
+#Session flow for the exercise_session scripts as a smach state machine. States sleep until
+#the next thing happens (a rep from ExerciseEval or a time limit) instead of polling.
+#A session is described by a plan, anything a script leaves out comes from DEFAULT_PLAN
+DEFAULT_PLAN = {'rounds': 1,
+                'announce_rounds': True,
+                'exercises': ['bicep_curls', 'lateral_raises'],
+                'sets': 2,
+                #A set ends with more than min_reps reps after min_length seconds, or at max_length seconds
+                'min_length': 30,
+                'max_length': 50,
+                'min_reps': 8,
+                #Seconds between starting tracking for a set and raising the arm
+                'setup_time': 2,
+                #Seconds between the get ready message and the set
+                'ready_time': 2,
+                #Asked before the set (followed by 6 s) and at the start of the rest
+                'ready_question': None,
+                'rest_question': None,
+                #Rest after each set and after the last set of a round, 0 for none
+                'rest': 40,
+                'round_rest': 80,
+                #Said once the last set is over
+                'end_message': None}
+
+def make_plan(**plan):
+    unknown = set(plan) - set(DEFAULT_PLAN)
+    if len(unknown) > 0:
+        raise ValueError('Unknown plan entries {}'.format(sorted(unknown)))
+    full_plan = dict(DEFAULT_PLAN)
+    full_plan.update(plan)
+    return full_plan
+
+def plan_sets(plan):
+    #Every exercise for plan['sets'] sets in each round, with the round rest after the last set of a round
+    sets = []
+    for round_num in range(1, plan['rounds']+1):
+        for exercise_name in plan['exercises']:
+            for set_num in range(1, plan['sets']+1):
+                sets.append({'round': round_num, 'exercise': exercise_name, 'set': set_num,
+                             'rest': plan['rest'], 'last_in_round': False})
+        sets[-1]['rest'] = plan['round_rest']
+        sets[-1]['last_in_round'] = True
+    return sets
+
+def plan_phrases(plan):
+    #Everything the session says for this plan, rep feedback not included
+    phrases = []
+    if plan['announce_rounds']:
+        for round_num in range(1, plan['rounds']+1):
+            phrases.append("Round %s out of %s." % (round_num, plan['rounds']))
+            phrases.append("End of Round {}".format(round_num))
+
+    for exercise_name in plan['exercises']:
+        for set_num in range(1, plan['sets']+1):
+            phrases.append("Get ready for set %s out of %s of %s" % (set_num, plan['sets'], exercise_name.replace("_", " " )))
+        phrases.append("Start %s now" % (exercise_name.replace("_", " " )))
+
+    phrases += ["Almost done.", "Rest."]
+    for rest_time in [plan['rest'], plan['round_rest']]:
+        if rest_time > 0:
+            phrases.append("Rest for {} more seconds.".format(int(rest_time/2)))
+    for phrase in [plan['ready_question'], plan['rest_question'], plan['end_message']]:
+        if phrase is not None:
+            phrases.append(phrase)
+    return phrases
+
+def sleep_until(clock, deadline):
+    remaining = deadline - clock.monotonic()
+    if remaining > 0 and not rospy.is_shutdown():
+        rospy.sleep(remaining)
+
+def record_set(exercise_eval, min_length, max_length, min_reps):
+    #Returns once there are more than min_reps reps after min_length seconds, or after max_length seconds
+    clock = exercise_eval.clock
+    start = clock.monotonic()
+    new_rep = threading.Event()
+
+    def on_rep(num_reps):
+        new_rep.set()
+
+    exercise_eval.rep_callbacks.append(on_rep)
+    try:
+        while not rospy.is_shutdown():
+            elapsed = clock.monotonic() - start
+            if elapsed >= max_length:
+                return 'max_length'
+            if len(exercise_eval.peaks[-1])-1 > min_reps and elapsed > min_length:
+                return 'min_reps'
+
+            #Woken by the next rep, otherwise at the next time limit
+            next_limit = min_length if elapsed <= min_length else max_length
+            new_rep.wait(next_limit - elapsed + 0.01)
+            new_rep.clear()
+    finally:
+        exercise_eval.rep_callbacks.remove(on_rep)
+
+def rest(feedback_controller, rest_start, rest_time):
+    #Reminder halfway through, then the rest of rest_time (both from rest_start)
+    clock = feedback_controller.clock
+    sleep_until(clock, rest_start + rest_time/2)
+    robot_message = "Rest for {} more seconds.".format(int(rest_time/2))
+    feedback_controller.message(robot_message)
+    sleep_until(clock, rest_start + rest_time)
+
+def smile(feedback_controller, robot_num):
+    if robot_num == 2:
+        feedback_controller.change_expression('smile', 0.6, 4)
+    elif robot_num == 3:
+        feedback_controller.change_expression('smile', 0.8, 4)
+
+
+class NextSet(smach.State):
+    def __init__(self, plan):
+        smach.State.__init__(self, outcomes=['new_round', 'next_set', 'complete'],
+                                    input_keys=['sm_sets', 'sm_set_index'],
+                                    output_keys=['sm_set_index', 'sm_current_set'])
+        self.plan = plan
+
+    def execute(self, userdata):
+        index = userdata.sm_set_index + 1
+        userdata.sm_set_index = index
+        if index >= len(userdata.sm_sets) or rospy.is_shutdown():
+            return 'complete'
+
+        userdata.sm_current_set = userdata.sm_sets[index]
+        if not self.plan['announce_rounds']:
+            return 'next_set'
+        if index == 0 or userdata.sm_sets[index-1]['round'] != userdata.sm_sets[index]['round']:
+            return 'new_round'
+        return 'next_set'
+
+
+class Round(smach.State):
+    def __init__(self, session):
+        smach.State.__init__(self, outcomes=['next_set'], input_keys=['sm_current_set'])
+        self.session = session
+
+    def execute(self, userdata):
+        feedback_controller = self.session.feedback_controller
+        num_rounds = self.session.plan['rounds']
+        round_num = userdata.sm_current_set['round']
+        feedback_controller.logger.info('=====================================')
+        feedback_controller.logger.info('STARTING ROUND {} OF {}'.format(round_num, num_rounds))
+        feedback_controller.logger.info('=====================================')
+
+        rospy.sleep(2)
+        robot_message = "Round %s out of %s." % (round_num, num_rounds)
+        feedback_controller.message(robot_message)
+        return 'next_set'
+
+
+class GetReady(smach.State):
+    def __init__(self, session):
+        smach.State.__init__(self, outcomes=['ready'], input_keys=['sm_current_set'])
+        self.session = session
+
+    def execute(self, userdata):
+        plan = self.session.plan
+        exercise_eval = self.session.exercise_eval
+        feedback_controller = self.session.feedback_controller
+        exercise_name = userdata.sm_current_set['exercise']
+        set_num = userdata.sm_current_set['set']
+
+        #Start a new set, only per-set state is reset
+        if self.session.on_set_start is not None:
+            self.session.on_set_start(userdata.sm_current_set)
+        exercise_eval.start_new_set(exercise_name, userdata.sm_current_set['round'], set_num)
+        feedback_controller.start_new_set()
+        rospy.sleep(plan['setup_time'])
+
+        feedback_controller.logger.info('=====================================')
+        feedback_controller.logger.info('STARTING SET {} OF {}'.format(set_num, exercise_name))
+        feedback_controller.logger.info('=====================================')
+
+        #Raise arm all the way up
+        feedback_controller.move_right_arm('up', 'halfway')
+
+        #Robot says starting set and smile
+        rospy.sleep(2)
+        robot_message = "Get ready for set %s out of %s of %s" % (set_num, plan['sets'], exercise_name.replace("_", " " ))
+        feedback_controller.message(robot_message)
+        smile(feedback_controller, self.session.robot_num)
+        rospy.sleep(plan['ready_time'])
+
+        if plan['ready_question'] is not None:
+            feedback_controller.message(plan['ready_question'])
+            rospy.sleep(6)
+
+        return 'ready'
+
+
+class Exercise(smach.State):
+    def __init__(self, session):
+        smach.State.__init__(self, outcomes=['done'], input_keys=['sm_current_set'])
+        self.session = session
+
+    def execute(self, userdata):
+        plan = self.session.plan
+        exercise_eval = self.session.exercise_eval
+        feedback_controller = self.session.feedback_controller
+        exercise_name = userdata.sm_current_set['exercise']
+        feedback_controller.logger.info('-------------------Recording!')
+
+        #Set time includes lowering the arm, as it always has
+        clock = exercise_eval.clock
+        start = clock.monotonic()
+
+        #Lower arm all the way down
+        feedback_controller.move_right_arm('halfway', 'sides')
+
+        #Tracking only runs while angles are recorded, it is paused through the robot's
+        #get ready speech and arm demonstration and resumes warm
+        exercise_eval.set_tracking(True)
+
+        #Robot says starting set
+        robot_message = "Start %s now" % (exercise_name.replace("_", " " ))
+        feedback_controller.message(robot_message)
+        exercise_eval.flag = True
+        feedback_controller.flag = True
+
+        elapsed = clock.monotonic() - start
+        reason = record_set(exercise_eval, plan['min_length'] - elapsed, plan['max_length'] - elapsed, plan['min_reps'])
+
+        exercise_eval.finish_set()
+        feedback_controller.logger.info('-------------------Done with exercise ({})'.format(reason))
+        return 'done'
+
+
+class Rest(smach.State):
+    def __init__(self, session):
+        smach.State.__init__(self, outcomes=['rested'], input_keys=['sm_current_set'])
+        self.session = session
+
+    def execute(self, userdata):
+        plan = self.session.plan
+        exercise_eval = self.session.exercise_eval
+        feedback_controller = self.session.feedback_controller
+        current_set = userdata.sm_current_set
+
+        robot_message = "Almost done."
+        feedback_controller.message(robot_message)
+        rospy.sleep(3)
+
+        robot_message = "Rest."
+        feedback_controller.message(robot_message)
+        smile(feedback_controller, self.session.robot_num)
+
+        rest_start = feedback_controller.clock.monotonic()
+
+        if plan['rest_question'] is not None:
+            feedback_controller.message(plan['rest_question'])
+
+        #Raise arm all the way up
+        feedback_controller.move_right_arm('sides', 'up')
+
+        if self.session.on_set_end is not None:
+            self.session.on_set_end(current_set)
+        if exercise_eval.rep_store is not None:
+            exercise_eval.rep_store.flush()
+
+        if current_set['last_in_round'] and plan['announce_rounds']:
+            robot_message = "End of Round {}".format(current_set['round'])
+            feedback_controller.message(robot_message)
+        if current_set['rest'] > 0:
+            rest(feedback_controller, rest_start, current_set['rest'])
+        return 'rested'
+
+
+class Session:
+
+    def __init__(self, plan, robot_num, log_filename, in_process=False, on_set_start=None, on_set_end=None, rep_store=None):
+        #Logging, publishers, expert templates, DTW workers, pose tracking and the TTS cache are
+        #set up once here, sets only reset their own state. on_set_start and on_set_end are
+        #called with the set's entry from plan_sets. rep_store (RepStore.RepStore) is written
+        #after every set
+        self.plan = plan
+        self.robot_num = robot_num
+        self.on_set_start = on_set_start
+        self.on_set_end = on_set_end
+
+        self.feedback_controller = FeedbackController(False, log_filename, robot_num)
+        self.exercise_eval = ExerciseEval(False, self.feedback_controller, exercises=plan['exercises'])
+        self.exercise_eval.flag = False
+        self.exercise_eval.rep_store = rep_store
+        if in_process:
+            from pose_tracking import start_tracking
+            self.camera, self.pose_tracking, self.face_tracking, self.warm_up_thread = start_tracking()
+            self.exercise_eval.connect_local(self.pose_tracking)
+
+        #quori_sound renders anything it does not have yet when asked for its length
+        self.feedback_controller.load_durations(plan_phrases(plan))
+
+        self.sets = plan_sets(plan)
+        self.state_machine = self.build()
+
+    def build(self):
+        sm = smach.StateMachine(outcomes=['complete'])
+        sm.userdata.sm_sets = self.sets
+        sm.userdata.sm_set_index = -1
+        sm.userdata.sm_current_set = None
+
+        with sm:
+            smach.StateMachine.add('NEXTSET', NextSet(self.plan),
+                                   transitions={'new_round': 'ROUND', 'next_set': 'GETREADY', 'complete': 'complete'})
+
+            smach.StateMachine.add('ROUND', Round(self),
+                                   transitions={'next_set': 'GETREADY'})
+
+            smach.StateMachine.add('GETREADY', GetReady(self),
+                                   transitions={'ready': 'EXERCISE'})
+
+            smach.StateMachine.add('EXERCISE', Exercise(self),
+                                   transitions={'done': 'REST'})
+
+            smach.StateMachine.add('REST', Rest(self),
+                                   transitions={'rested': 'NEXTSET'})
+
+        return sm
+
+    def run(self):
+        self.exercise_eval.wait_for_tracking()
+        outcome = self.state_machine.execute()
+        if self.exercise_eval.rep_store is not None:
+            self.exercise_eval.rep_store.flush()
+
+        if self.plan['end_message'] is not None:
+            rospy.sleep(8)
+            self.feedback_controller.message(self.plan['end_message'])
+        return outcome
+
+    def save(self, data_filename):
+        exercise_eval = self.exercise_eval
+        np.savez('src/quori_exercises/saved_data/{}'.format(data_filename),
+                            angles=exercise_eval.angles,
+                            peaks=exercise_eval.peaks,
+                            feedback=exercise_eval.feedback,
+                            times=exercise_eval.times,
+                            exercise_names=exercise_eval.exercise_name_list
+                        )
+        self.feedback_controller.logger.info('Saved file {}'.format(data_filename))
@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 import rospy
-from pytz import timezone
-from datetime import datetime
 import numpy as np
 
-import logging
-
 from ExerciseEval import ExerciseEval
 from FeedbackController import FeedbackController
+from EventLog import shutdown_logging
+from SessionRunner import Session, make_plan
+from RepStore import RepStore
 
 #Fixed parameters
 MIN_LENGTH = 30
@@ -17,6 +16,19 @@ REST_TIME = 40
 ROUND_REST_TIME = 80
 NUM_ROUNDS = 1 
 
+#Session plan, see SessionRunner.DEFAULT_PLAN
+PLAN = make_plan(rounds=NUM_ROUNDS,
+                 exercises=['bicep_curls', 'lateral_raises'],
+                 sets=NUM_SETS,
+                 min_length=MIN_LENGTH,
+                 max_length=MAX_LENGTH,
+                 rest=REST_TIME,
+                 round_rest=ROUND_REST_TIME)
+
+#Run pose tracking inside this process instead of the pose_tracking node
+#(launch quori_robot_main.launch with pose_tracking:=false)
+IN_PROCESS = False
+
 #Change at beginning of study
 PARTICIPANT_ID = '1'
 
@@ -60,134 +72,18 @@ def live_session():
     #Start log file
     log_filename = 'Participant_{}_Robot_{}.log'.format(PARTICIPANT_ID, ROBOT_NUM)
 
-    #Initialize the feedback controller
-    feedback_controller = FeedbackController(False, log_filename, ROBOT_NUM)
-
-    #Initialize evaluation object
-    exercise_eval = ExerciseEval(False, feedback_controller)
-    exercise_eval.flag = False
-
-
-    #For each exercise and set
-    for round_num in range(1, NUM_ROUNDS+1):
-
-        #New Round
-        exercise_eval.feedback_controller.logger.info('=====================================')
-        exercise_eval.feedback_controller.logger.info('STARTING ROUND {} OF {}'.format(round_num, 3))
-        exercise_eval.feedback_controller.logger.info('=====================================')
-
-        rospy.sleep(2)
-        robot_message = "Round %s out of 3." % (round_num)
-        exercise_eval.feedback_controller.message(robot_message)
-
-        for exercise_name in ['bicep_curls', 'lateral_raises']:
-            for set_num in range(1, NUM_SETS+1):
-                if exercise_name == 'lateral_raises' and set_num == NUM_SETS:
-                    is_final = True
-                else:
-                    is_final = False
-
-                #Start a new set
-                exercise_eval.start_new_set(exercise_name)
-                feedback_controller.start_new_set()
-                rospy.sleep(2)
-
-                exercise_eval.feedback_controller.logger.info('=====================================')
-                exercise_eval.feedback_controller.logger.info('STARTING SET {} OF {}'.format(set_num, exercise_name))
-                exercise_eval.feedback_controller.logger.info('=====================================')
-
-                #Raise arm all the way up
-                feedback_controller.move_right_arm('up', 'halfway')
-
-                #Robot says starting set and smile
-                rospy.sleep(2)
-                robot_message = "Get ready for set %s out of %s of %s" % (set_num, NUM_SETS, exercise_name.replace("_", " " ))
-
-                exercise_eval.feedback_controller.message(robot_message)
-
-                if ROBOT_NUM == 2:
-                    feedback_controller.change_expression('smile', 0.6, 4)
-                elif ROBOT_NUM == 3:
-                    feedback_controller.change_expression('smile', 0.8, 4)
-                rospy.sleep(2)
-
-                inittime = datetime.now(timezone('EST'))
-                exercise_eval.feedback_controller.logger.info('-------------------Recording!')
-                start_message = False
-
-                #Lower arm all the way down
-                feedback_controller.move_right_arm('halfway', 'sides')
-
-                #Stop between minimum and maximum time and minimum reps
-                while (datetime.now(timezone('EST')) - inittime).total_seconds() < MAX_LENGTH:        
-                
-                    #Robot says starting set
-                    if not start_message:
-                        robot_message = "Start %s now" % (exercise_name.replace("_", " " ))
-                        exercise_eval.feedback_controller.message(robot_message)
-                        start_message = True
-
-                    exercise_eval.flag = True
-                    feedback_controller.flag = True
-
-                    #If number of reps is greater than 8 and they have been exercising at least the minimum length
-                    if len(exercise_eval.peaks[-1])-1 > 8 and (datetime.now(timezone('EST')) - inittime).total_seconds() > MIN_LENGTH:
-                        break 
-
-                exercise_eval.flag = False
-                exercise_eval.feedback_controller.logger.info('-------------------Done with exercise')
-
-                robot_message = "Almost done."
-                exercise_eval.feedback_controller.message(robot_message)
-                rospy.sleep(3)
-
-                robot_message = "Rest."
-                exercise_eval.feedback_controller.message(robot_message)
-                if ROBOT_NUM == 2:
-                    feedback_controller.change_expression('smile', 0.6, 4)
-                elif ROBOT_NUM == 3:
-                    feedback_controller.change_expression('smile', 0.8, 4)
-
-                rest_start = datetime.now(timezone('EST'))
-
-                #Raise arm all the way up
-                feedback_controller.move_right_arm('sides', 'up')
-
-                if not is_final:
-                    halfway_message = False
-                    while (datetime.now(timezone('EST')) - rest_start).total_seconds() < REST_TIME:
-                        
-                        #Print halfway done with rest here
-                        if (datetime.now(timezone('EST')) - rest_start).total_seconds() > REST_TIME/2 and not halfway_message:
-                            halfway_message = True
-                            robot_message = "Rest for {} more seconds.".format(int(REST_TIME/2))
-                            exercise_eval.feedback_controller.message(robot_message)
-                else:
-                    robot_message = "End of Round {}".format(round_num)
-                    exercise_eval.feedback_controller.message(robot_message)
-
-                    halfway_message = False
-                    while (datetime.now(timezone('EST')) - rest_start).total_seconds() < ROUND_REST_TIME:
-                        
-                        #Print halfway done with rest here
-                        if (datetime.now(timezone('EST')) - rest_start).total_seconds() > ROUND_REST_TIME/2 and not halfway_message:
-                            halfway_message = True
-                            robot_message = "Rest for {} more seconds.".format(int(ROUND_REST_TIME/2))
-                            exercise_eval.feedback_controller.message(robot_message)
+    #Per-rep results for analysis, see RepStore.query
+    rep_store = RepStore('src/quori_exercises/saved_data/reps/Participant_{}_Robot_{}'.format(PARTICIPANT_ID, ROBOT_NUM),
+                         participant=PARTICIPANT_ID, robot=ROBOT_NUM)
+
+    #Everything is set up before the first set
+    session = Session(PLAN, ROBOT_NUM, log_filename, IN_PROCESS, rep_store=rep_store)
+    session.run()
 
-    
     data_filename = 'Participant_{}_Robot_{}.npz'.format(PARTICIPANT_ID, ROBOT_NUM)
-    np.savez('src/quori_exercises/saved_data/{}'.format(data_filename),      
-                            angles=exercise_eval.angles,
-                            peaks=exercise_eval.peaks,
-                            feedback=exercise_eval.feedback,
-                            times=exercise_eval.times,
-                            exercise_names=exercise_eval.exercise_name_list
-                        )
-    exercise_eval.feedback_controller.logger.info('Saved file {}'.format(data_filename))
-
-    exercise_eval.feedback_controller.logger.handlers.clear()
-    logging.shutdown()
+    session.save(data_filename)
+
+    shutdown_logging()
     print('Done!')
 
 if __name__ == '__main__':
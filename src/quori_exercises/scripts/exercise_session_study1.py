@@ -1,13 +1,12 @@
 #!/usr/bin/env python3
 import rospy
-from pytz import timezone
-from datetime import datetime
 import numpy as np
 
-import logging
-
 from ExerciseEval import ExerciseEval
 from FeedbackController import FeedbackController
+from EventLog import shutdown_logging
+from SessionRunner import Session, make_plan
+from RepStore import RepStore
 
 #Fixed parameters
 MIN_LENGTH = 30
@@ -55,112 +54,53 @@ def replay(filename, re_eval):
 
     exercise_eval.plot_results()
 
-def live_session(exercise_name, set_num, is_final):
-    #Start log file
-    log_filename = 'Participant_{}_Round_{}_Robot_{}_Exercise_{}_Set_{}.log'.format(PARTICIPANT_ID, ROUND_NUM, ROBOT_NUM, exercise_name, set_num)
-
-    #Initialize the feedback controller
-    feedback_controller = FeedbackController(False, log_filename, ROBOT_NUM)
-
-    #Initialize evaluation object
-    exercise_eval = ExerciseEval(False, EXERCISE_NAME, feedback_controller)
-
-    #Starting set
-    exercise_eval.feedback_controller.logger.info('=====================================')
-    exercise_eval.feedback_controller.logger.info('STARTING SET {} OF {}'.format(set_num, exercise_name))
-    exercise_eval.feedback_controller.logger.info('=====================================')
-
-    #Raise arm all the way up
-    feedback_controller.move_right_arm('up', 'halfway')
-
-    #Robot says starting set and smile
-    rospy.sleep(2)
-    robot_message = "Get ready for set %s out of %s of %s" % (set_num,
-                                                        NUM_SETS, exercise_name.replace("_", " " ))
-    exercise_eval.feedback_controller.message(robot_message)
-    if ROBOT_NUM == 2:
-        feedback_controller.change_expression('smile', 0.6, 4)
-    elif ROBOT_NUM == 3:
-        feedback_controller.change_expression('smile', 0.8, 4)
-    rospy.sleep(6)
-
-    inittime = datetime.now(timezone('EST'))
-    exercise_eval.feedback_controller.logger.info('-------------------Recording!')
-    start_message = False
-
-    #Lower arm all the way down
-    feedback_controller.move_right_arm('halfway', 'sides')
-
-    #Stop between minimum and maximum time and minimum reps
-    while (datetime.now(timezone('EST')) - inittime).total_seconds() < MAX_LENGTH:        
-    
-        #Robot says starting set
-        if not start_message:
-            robot_message = "Start %s now" % (exercise_name.replace("_", " " ))
-            exercise_eval.feedback_controller.message(robot_message)
-            start_message = True
-
-        exercise_eval.flag = True
-        feedback_controller.flag = True
-
-        #If number of reps is greater than 8 and they have been exercising at least the minimum length
-        if len(exercise_eval.peaks)-1 > 8 and (datetime.now(timezone('EST')) - inittime).total_seconds() > MIN_LENGTH:
-            break 
-
-    exercise_eval.flag = False
-    exercise_eval.feedback_controller.logger.info('-------------------Done with exercise')
-
-    robot_message = "Almost done."
-    exercise_eval.feedback_controller.message(robot_message)
-    rospy.sleep(3)
-
-    robot_message = "Rest."
-    exercise_eval.feedback_controller.message(robot_message)
-    if ROBOT_NUM == 2:
-        feedback_controller.change_expression('smile', 0.6, 4)
-    elif ROBOT_NUM == 3:
-        feedback_controller.change_expression('smile', 0.8, 4)
-
-    rest_start = datetime.now(timezone('EST'))
-
-    robot_message = "Using the scale next to you, how difficult was that last set, from 1 to 10?"
-    exercise_eval.feedback_controller.message(robot_message)
-
-    #Raise arm all the way up
-    feedback_controller.move_right_arm('sides', 'up')
-
-    #Get summary statistics
-    exercise_eval.feedback_controller.logger.info('Total Number of Reps {}'.format(len(exercise_eval.peaks)-1))
-
-    exercise_eval.feedback_controller.logger.info('Total Angles {}'.format(exercise_eval.angles.shape[0]))
-
-    exercise_eval.pose_sub.unregister()
-    
-    data_filename = 'Participant_{}_Round_{}_Robot_{}_Exercise_{}_Set_{}.npz'.format(PARTICIPANT_ID, ROUND_NUM, ROBOT_NUM, exercise_name, set_num)
-    np.savez('src/quori_exercises/saved_data/{}'.format(data_filename),      
-                            angles=exercise_eval.angles,
-                            peaks=exercise_eval.peaks,
-                            feedback=exercise_eval.feedback,
-                            times=exercise_eval.times,
-                            exercise_name=exercise_name
-                        )
-    exercise_eval.feedback_controller.logger.info('Saved file {}'.format(data_filename))
-
-    if not is_final:
-        halfway_message = False
-        while (datetime.now(timezone('EST')) - rest_start).total_seconds() < REST_TIME:
-            
-            #Print halfway done with rest here
-            if (datetime.now(timezone('EST')) - rest_start).total_seconds() > REST_TIME/2 and not halfway_message:
-                halfway_message = True
-                robot_message = "Rest for {} more seconds.".format(int(REST_TIME/2))
-                exercise_eval.feedback_controller.message(robot_message)
-    else:
-        rospy.sleep(8)
-        robot_message = "Please walk over to the researcher to fill out a survey."
-        exercise_eval.feedback_controller.message(robot_message)
-
-    logging.shutdown()
+def set_filename(current_set, extension):
+    return 'Participant_{}_Round_{}_Robot_{}_Exercise_{}_Set_{}.{}'.format(PARTICIPANT_ID, ROUND_NUM, ROBOT_NUM, current_set['exercise'], current_set['set'], extension)
+
+def live_session():
+    #One round of every exercise, each set logged and saved to its own files. Nothing is said
+    #about rounds and the last set ends with the survey instead of a rest
+    plan = make_plan(announce_rounds=False,
+                     exercises=['bicep_curls', 'lateral_raises'],
+                     sets=NUM_SETS,
+                     min_length=MIN_LENGTH,
+                     max_length=MAX_LENGTH,
+                     setup_time=0,
+                     ready_time=6,
+                     rest_question="Using the scale next to you, how difficult was that last set, from 1 to 10?",
+                     rest=REST_TIME,
+                     round_rest=0,
+                     end_message="Please walk over to the researcher to fill out a survey.")
+
+    def on_set_start(current_set):
+        #Start log file
+        session.feedback_controller.set_log_file(set_filename(current_set, 'log'))
+
+    def on_set_end(current_set):
+        exercise_eval = session.exercise_eval
+
+        #Get summary statistics
+        exercise_eval.feedback_controller.logger.info('Total Number of Reps {}'.format(len(exercise_eval.peaks[-1])-1))
+
+        exercise_eval.feedback_controller.logger.info('Total Angles {}'.format(exercise_eval.angles[-1].shape[0]))
+
+        data_filename = set_filename(current_set, 'npz')
+        np.savez('src/quori_exercises/saved_data/{}'.format(data_filename),      
+                                angles=exercise_eval.angles[-1],
+                                peaks=exercise_eval.peaks[-1],
+                                feedback=exercise_eval.feedback[-1],
+                                times=exercise_eval.times[-1],
+                                exercise_name=current_set['exercise']
+                            )
+        exercise_eval.feedback_controller.logger.info('Saved file {}'.format(data_filename))
+
+    #Per-rep results for analysis, the study round is the same for every set
+    rep_store = RepStore('src/quori_exercises/saved_data/reps/Participant_{}_Round_{}_Robot_{}'.format(PARTICIPANT_ID, ROUND_NUM, ROBOT_NUM),
+                         participant=PARTICIPANT_ID, robot=ROBOT_NUM, round=ROUND_NUM)
+
+    first_set = {'exercise': plan['exercises'][0], 'set': 1}
+    session = Session(plan, ROBOT_NUM, set_filename(first_set, 'log'), on_set_start=on_set_start, on_set_end=on_set_end, rep_store=rep_store)
+    session.run()
 
 if __name__ == '__main__':
     
@@ -187,11 +127,6 @@ if __name__ == '__main__':
 
         rate = rospy.Rate(10)
 
-        #For each exercise and set
-        for EXERCISE_NAME in ['bicep_curls', 'lateral_raises']:
-            for SET_NUM in range(1, NUM_SETS+1):
-                if EXERCISE_NAME == 'lateral_raises' and SET_NUM == NUM_SETS:
-                    is_final = True
-                else:
-                    is_final = False
-                live_session(EXERCISE_NAME, SET_NUM, is_final)
+        live_session()
+
+        shutdown_logging()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import multiprocessing
+from datetime import datetime, timedelta
+from pytz import timezone
+import numpy as np
+import cv2
+import mediapipe as mp
+
+from PoseAngles import LANDMARK_POINTS, JOINTS, POSE_CONFIG, calc_angles, landmarks_to_array
+
+#Offline version of the pose_tracking.py recording mode: videos are split into chunks of
+#frames that are processed in parallel, and the results are saved with the same npz layout
+#so they can be passed straight to create_experts.py
+
+def count_frames(filename):
+    capture = cv2.VideoCapture(filename)
+    if not capture.isOpened():
+        raise IOError('Could not open {}'.format(filename))
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return num_frames, fps
+
+def process_chunk(args):
+    filename, start, end, fps = args
+
+    capture = cv2.VideoCapture(filename)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    pose_detector = mp.solutions.pose.Pose(**POSE_CONFIG)
+
+    landmarks = []
+    times = []
+    angles = []
+    for frame_index in range(start, end):
+        ok, frame = capture.read()
+        if not ok:
+            break
+
+        #OpenCV decodes to BGR, the camera stream is RGB
+        results = pose_detector.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        if results.pose_landmarks:
+            frame_landmarks = landmarks_to_array(results.pose_landmarks)
+            landmarks.append(frame_landmarks)
+            times.append(frame_index/fps)
+            angles.append(calc_angles(frame_landmarks))
+
+    pose_detector.close()
+    capture.release()
+
+    return (np.array(landmarks).reshape(-1, len(LANDMARK_POINTS), 3),
+            np.array(times),
+            np.array(angles).reshape(-1, len(JOINTS)))
+
+def main(filenames, output_dir, chunk_size, num_workers):
+    tz = timezone('EST')
+
+    #Split every video into chunks of frames
+    tasks = []
+    for filename in filenames:
+        num_frames, fps = count_frames(filename)
+        if fps <= 0:
+            fps = 30.0
+        print('{}: {} frames at {:.1f} fps'.format(filename, num_frames, fps))
+        for start in range(0, num_frames, chunk_size):
+            tasks.append((filename, start, min(start + chunk_size, num_frames), fps))
+
+    with multiprocessing.Pool(num_workers) as pool:
+        results = pool.map(process_chunk, tasks)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for filename in filenames:
+        chunks = [result for task, result in zip(tasks, results) if task[0] == filename]
+        if len(chunks) == 0:
+            continue
+
+        landmarks = np.concatenate([chunk[0] for chunk in chunks])
+        seconds = np.concatenate([chunk[1] for chunk in chunks])
+        angles = np.concatenate([chunk[2] for chunk in chunks])
+
+        #Times are datetimes like the live recording, starting from the file's modification time
+        video_start = datetime.fromtimestamp(os.path.getmtime(filename), tz)
+        times = np.array([video_start + timedelta(seconds=s) for s in seconds])
+
+        output = os.path.join(output_dir, os.path.splitext(os.path.basename(filename))[0] + '.npz')
+        np.savez(output, landmarks=landmarks,
+                            times=times,
+                            angles=angles,
+                            landmark_points=LANDMARK_POINTS,
+                            joints=JOINTS)
+        print('Saved {} poses to {}'.format(angles.shape[0], output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract pose angles from video files for create_experts.py')
+    parser.add_argument('videos', nargs='+')
+    parser.add_argument('--output-dir', default='./experts')
+    parser.add_argument('--chunk-size', type=int, default=900, help='frames per task')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    main(args.videos, args.output_dir, args.chunk_size, args.workers)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+from FeedbackController import FEEDBACK_MESSAGES
+from SessionRunner import plan_phrases
+from exercise_session_rpe import PLAN
+
+#Everything the robot says during a session, one phrase per line, to pre-render quori_sound's TTS cache:
+#  rosrun quori_exercises list_phrases.py | rosrun quori_controller quori_sound.py --prerender -
+#Sessions also ask quori_sound to render their plan's phrases when they start
+EXTRA_PHRASES = ["Using the scale next to you, how difficult was that last set, from 1 to 10?",
+                 "Please walk over to the researcher to fill out a survey."]
+
+def session_phrases():
+    return plan_phrases(PLAN) + EXTRA_PHRASES
+
+def feedback_phrases():
+    return [m for options in FEEDBACK_MESSAGES.values() for robot_options in options.values() for m in robot_options]
+
+def list_phrases():
+    phrases = []
+    for phrase in session_phrases() + feedback_phrases():
+        if phrase != '' and phrase not in phrases:
+            phrases.append(phrase)
+    return phrases
+
+if __name__ == '__main__':
+    for phrase in list_phrases():
+        print(phrase)
@@ -1,165 +1,361 @@
 #!/usr/bin/env python3
 import rospy
-from std_msgs.msg import Float64MultiArray
+from std_msgs.msg import Float64MultiArray, Bool
+from std_srvs.srv import SetBool, SetBoolResponse
+from rospy.numpy_msg import numpy_msg
+from quori_exercises.msg import JointAngles
 from pytz import timezone
 from datetime import datetime
+import time
+import threading
+import queue
 import numpy as np
 import mediapipe as mp
-from sensor_msgs.msg import Image
+import cv2
 from fer import FER
 
+from CameraStream import CameraStream
+from PoseRecorder import PoseRecorder, save_npz
+from PoseGovernor import PoseGovernor
+from PoseAngles import LANDMARK_POINTS, JOINTS, POSE_CONFIG, calc_angles, landmarks_to_array
+
 import warnings
 warnings.filterwarnings("ignore")
 
+tz = timezone('EST')
+
 class PoseTracking:
 
-    def __init__(self):
-        self.sub = rospy.Subscriber("/astra_ros/devices/default/color/image_color", Image, self.callback)
+    def __init__(self, camera, rate=0, roi=False, inference_width=0, publish_landmarks=False, governor=None):
+        #Typed angles serialized straight from numpy buffers, the untyped topic is kept for old listeners
+        self.angle_pub = rospy.Publisher('joint_angles_stamped', numpy_msg(JointAngles), queue_size=10)
+        self.legacy_angle_pub = rospy.Publisher('joint_angles', Float64MultiArray, queue_size=10)
+        self.publish_landmarks = publish_landmarks
+        self.seq = 0
+
+        #In-process consumers (ExerciseEval.connect_local), fed without going through ROS
+        self.listeners = []
+
+        #ROI mode crops to the body seen in the previous frame, inference_width (0 = none) downscales before inference
+        self.roi_mode = roi
+        self.roi = None
+        self.roi_margin = 0.25
+        #Region the detector saw last, its tracking is reset whenever this changes
+        self.crop_box = None
+        self.inference_width = inference_width
         
-        self.landmark_points = ['nose', 'left_eye_inner', 'left_eye', 'left_eye_outer', 'right_eye_inner', 'right_eye', 'right_eye_outer', 'left_ear', 'right_ear', 'mouth_left', 'mouth_right', 'left_shoulder', 'right_shoulder', 'left_elbow', 'right_elbow', 'left_wrist', 'right_wrist', 'left_pinky', 'right_pinky', 'left_index', 'right_index', 'left_thumb', 'right_thumb', 'left_hip', 'right_hip', 'left_knee', 'right_knee', 'left_ankle', 'right_ankle', 'left_heel', 'right_heel', 'left_foot_index', 'right_foot_index']
-        self.all_landmarks = []
-        self.all_times = []
-        self.all_angles = []
-        self.pose_detector = mp.solutions.pose.Pose(
-                    min_detection_confidence=0.5,  # have some confidence baseline
-                    min_tracking_confidence=0.5,
-                    model_complexity=0,)
+        self.landmark_points = LANDMARK_POINTS
+        self.latest_landmarks = None
+        self.recorder = None
+        self.pose_detectors = {}
+        self.set_model_complexity(POSE_CONFIG['model_complexity'])
+
+        #Optional PoseGovernor that trades model complexity and resolution against latency
+        self.governor = governor
+        if self.governor is not None:
+            self.set_model_complexity(self.governor.model_complexity)
+            self.inference_width = self.governor.inference_width
         self.flag = False
-        self.joints = [['right_hip', 'right_shoulder', 'right_elbow', 'xy', 'right shoulder'], 
-                        ['left_hip', 'left_shoulder', 'left_elbow', 'xy', 'left shoulder'],
-                        ['right_hip', 'right_shoulder', 'right_elbow', 'yz', 'right shoulder'], 
-                        ['left_hip', 'left_shoulder', 'left_elbow', 'yz', 'left shoulder'],
-                        ['right_hip', 'right_shoulder', 'right_elbow', 'xz', 'right shoulder'], 
-                        ['left_hip', 'left_shoulder', 'left_elbow', 'xz', 'left shoulder'],
-                        ['right_shoulder', 'right_elbow', 'right_wrist', 'xy', 'right elbow'], 
-                        ['left_shoulder', 'left_elbow', 'left_wrist', 'xy', 'left elbow'],
-                        ['right_shoulder', 'right_elbow', 'right_wrist', 'xz', 'right elbow'],
-                        ['left_shoulder', 'left_elbow', 'left_wrist', 'xz', 'left elbow'],
-                        ['right_shoulder', 'right_elbow', 'right_wrist', 'yz', 'right elbow'],
-                        ['left_shoulder', 'left_elbow', 'left_wrist', 'yz', 'left elbow']]
-
-    def calc_angle(self, vec_0, vec_1, angle_type):
-        if angle_type == 'xy':
-            angle = np.arctan2(vec_1[1], vec_1[1]) - \
-                np.arctan2(-vec_0[1], vec_0[0])
-        elif angle_type == 'yz':
-            angle = np.arctan2(vec_1[1], vec_1[2]) - \
-                np.arctan2(-vec_0[1], -vec_0[2])
-        elif angle_type == 'xz':
-            angle = np.arctan2(vec_1[2], vec_1[0]) - \
-                np.arctan2(-vec_0[2], -vec_0[0])
-        
-        angle = np.abs(angle*180.0/np.pi)
-        if angle > 180:
-            angle = 360-angle
-
-        return 180 - angle
-
-    def callback(self, data):
-        if not self.flag:
+        self.ready = False
+        self.joints = JOINTS
+
+        #Last, callbacks can start as soon as the consumer is registered
+        self.consumer = camera.add_consumer(self.callback, rate, 'pose_tracking')
+
+    def set_model_complexity(self, model_complexity):
+        #Detectors are kept per complexity so switching back and forth stays warm
+        if model_complexity not in self.pose_detectors:
+            config = dict(POSE_CONFIG)
+            config['model_complexity'] = model_complexity
+            self.pose_detectors[model_complexity] = mp.solutions.pose.Pose(**config)
+        self.pose_detector = self.pose_detectors[model_complexity]
+        self.model_complexity = model_complexity
+        #This detector's tracking state is from whatever it saw before
+        self.crop_box = None
+
+    def body_box(self, landmarks, width, height, margin):
+        #Pixel bounding box around the landmarks, padded by margin on every side
+        x_min, y_min = np.clip(np.min(landmarks[:, :2], axis=0), 0, 1)
+        x_max, y_max = np.clip(np.max(landmarks[:, :2], axis=0), 0, 1)
+        pad_x = (x_max - x_min)*margin
+        pad_y = (y_max - y_min)*margin
+
+        x0 = int(max(0, (x_min - pad_x)*width))
+        y0 = int(max(0, (y_min - pad_y)*height))
+        x1 = int(min(width, np.ceil((x_max + pad_x)*width)))
+        y1 = int(min(height, np.ceil((y_max + pad_y)*height)))
+
+        #Too small to be a person, go back to full frame detection
+        if x1 - x0 < 32 or y1 - y0 < 32:
+            return None
+        return x0, y0, x1, y1
+
+    def update_roi(self, landmarks, width, height):
+        #The crop is kept while the body, padded by half the margin, stays inside it and fills at
+        #least half of it. The detector's tracking and landmark smoothing then see a fixed view
+        box = self.body_box(landmarks, width, height, self.roi_margin)
+        if box is None or self.roi is None:
+            return box
+        x0, y0, x1, y1 = self.roi
+        inner = self.body_box(landmarks, width, height, self.roi_margin/2)
+        if inner is not None and inner[0] >= x0 and inner[1] >= y0 and inner[2] <= x1 and inner[3] <= y1 \
+                and (box[2] - box[0])*(box[3] - box[1]) >= 0.5*(x1 - x0)*(y1 - y0):
+            return self.roi
+        return box
+
+    def detect(self, image):
+        height, width = image.shape[:2]
+
+        if self.roi_mode and self.roi is not None:
+            x0, y0, x1, y1 = self.roi
+        else:
+            x0, y0, x1, y1 = 0, 0, width, height
+        crop = image[y0:y1, x0:x1]
+
+        if (x0, y0, x1, y1) != self.crop_box:
+            #Re-cropped, start tracking over instead of smoothing across the jump
+            self.pose_detector.reset()
+            self.crop_box = (x0, y0, x1, y1)
+
+        #Downscale only, keeping the aspect ratio so normalized coordinates stay valid
+        if self.inference_width > 0 and crop.shape[1] > self.inference_width:
+            scale = self.inference_width / crop.shape[1]
+            crop = cv2.resize(crop, (self.inference_width, max(1, int(round(crop.shape[0]*scale)))), interpolation=cv2.INTER_AREA)
+
+        results = self.pose_detector.process(crop)
+        if not results.pose_landmarks:
+            #Lost tracking, search the full frame next time
+            self.roi = None
+            return None
+
+        landmarks = landmarks_to_array(results.pose_landmarks)
+
+        #Map back to full frame normalized coordinates (z uses the same scale as x)
+        landmarks[:, 0] = (landmarks[:, 0]*(x1 - x0) + x0)/width
+        landmarks[:, 1] = (landmarks[:, 1]*(y1 - y0) + y0)/height
+        landmarks[:, 2] = landmarks[:, 2]*(x1 - x0)/width
+
+        if self.roi_mode:
+            self.roi = self.update_roi(landmarks, width, height)
+        return landmarks
+
+    def warm_up(self, image, iterations=3):
+        #Run dummy inferences so the first real frame does not pay for lazy model initialization
+        current = self.model_complexity
+        complexities = [current]
+        if self.governor is not None:
+            complexities = sorted(set(level[0] for level in self.governor.levels))
+
+        for model_complexity in complexities:
+            self.set_model_complexity(model_complexity)
+            for ii in range(iterations):
+                start = time.monotonic()
+                self.detect(image)
+                rospy.loginfo('Pose model (complexity {}) warm-up {}: {:.1f} ms'.format(model_complexity, ii, 1000*(time.monotonic() - start)))
+
+        self.set_model_complexity(current)
+        self.roi = None
+        self.ready = True
+
+    def callback(self, image, stamp):
+        if not self.flag or not self.ready:
             return
 
-        image = np.frombuffer(data.data, dtype=np.uint8).reshape(
-            data.height, data.width, -1)
-        results = self.pose_detector.process(image)
-
-        if results.pose_landmarks:
-            ct = datetime.now(tz)
+        start = time.monotonic()
+        landmarks = self.detect(image)
 
-            landmarks = []
-            for i, landmark in enumerate(results.pose_landmarks.landmark):
-                landmarks.append([landmark.x, landmark.y, landmark.z])
+        if self.governor is not None and self.governor.update(time.monotonic() - start):
+            self.set_model_complexity(self.governor.model_complexity)
+            self.inference_width = self.governor.inference_width
+            rospy.loginfo('Pose governor: {}'.format(self.governor.last_change))
 
-            self.all_landmarks.append(landmarks)
+        if landmarks is not None:
+            ct = datetime.now(tz)
 
-            self.all_times.append(ct)
+            #Shared with FaceTracking to locate the face without running a detector
+            self.latest_landmarks = (time.monotonic(), landmarks)
 
             #Calculate all angles we could need
-            angles = []
-            for joint in self.joints:
-                #Indices
-                indices = [self.landmark_points.index(joint[i]) for i in range(3)]
-                points = [np.array(landmarks[i]) for i in indices]
-
-                vec_0 = points[0] - points[1]
-                vec_1 = points[2] - points[1]
-
-                angle = self.calc_angle(vec_0, vec_1, joint[3])
-                angles.append(angle)
-
-            self.all_angles.append(angles)
-            angle_msg = Float64MultiArray()
-            angle_msg.data = angles
-            angle_pub.publish(angle_msg)
+            angles = calc_angles(landmarks)
+
+            if self.recorder is not None:
+                self.recorder.append(ct, landmarks, angles)
+
+            self.seq += 1
+            for listener in self.listeners:
+                try:
+                    listener.put_nowait((self.seq, np.asarray(angles, dtype=np.float64)))
+                except queue.Full:
+                    #Shows up as a sequence gap on the consumer side
+                    pass
+
+            angle_msg = JointAngles()
+            angle_msg.header.stamp = stamp
+            angle_msg.seq = self.seq
+            angle_msg.angles = np.asarray(angles, dtype=np.float64)
+            if self.publish_landmarks:
+                angle_msg.landmarks = landmarks.astype(np.float32).ravel()
+            else:
+                angle_msg.landmarks = np.empty(0, dtype=np.float32)
+            self.angle_pub.publish(angle_msg)
+
+            if self.legacy_angle_pub.get_num_connections() > 0:
+                legacy_msg = Float64MultiArray()
+                legacy_msg.data = angles
+                self.legacy_angle_pub.publish(legacy_msg)
 
 
 class FaceTracking:
-    def __init__(self):
-        self.sub = rospy.Subscriber("/astra_ros/devices/default/color/image_color", Image, self.callback)
+    def __init__(self, camera, rate=0, pose_tracking=None):
+        self.face_pub = rospy.Publisher('facial_features', Float64MultiArray, queue_size=10)
         self.flag = False
+        self.ready = False
         self.face_detector = FER()
+
+        #Face landmarks from the pose model: nose, eyes, ears and mouth
+        self.pose_tracking = pose_tracking
+        self.face_landmarks = list(range(11))
+        self.max_landmark_age = 0.5
+
+        #Last, callbacks can start as soon as the consumer is registered
+        self.consumer = camera.add_consumer(self.callback, rate, 'face_tracking')
+
+    def face_box(self, width, height):
+        #Face rectangle (x, y, w, h) in pixels from recent pose landmarks, None if unavailable and
+        #zero sized if the face is (mostly) out of the image
+        if self.pose_tracking is None or self.pose_tracking.latest_landmarks is None:
+            return None
+
+        landmark_time, landmarks = self.pose_tracking.latest_landmarks
+        if time.monotonic() - landmark_time > self.max_landmark_age:
+            return None
+
+        points = landmarks[self.face_landmarks, :2]*[width, height]
+        center = np.mean(points, axis=0)
+        #Ear to ear span is roughly the face width, pad it to include forehead and chin
+        side = int(np.ceil(1.6*np.max(np.ptp(points, axis=0))))
+        if side < 24:
+            return None
+
+        #Clamped to the image once the square is placed
+        x0 = int(round(center[0] - side/2))
+        y0 = int(round(center[1] - side/2))
+        x1 = min(width, x0 + side)
+        y1 = min(height, y0 + side)
+        x0 = max(0, x0)
+        y0 = max(0, y0)
+        if x1 - x0 < 24 or y1 - y0 < 24:
+            return x0, y0, 0, 0
+        return x0, y0, x1 - x0, y1 - y0
         
-    def callback(self, data):
-        if not self.flag:
+    def warm_up(self, image, iterations=3):
+        #Both the face detector and the emotion model are initialized lazily
+        side = min(image.shape[:2])//2
+        for ii in range(iterations):
+            start = time.monotonic()
+            self.face_detector.detect_emotions(image)
+            self.face_detector.detect_emotions(image, face_rectangles=[(0, 0, side, side)])
+            rospy.loginfo('Face model warm-up {}: {:.1f} ms'.format(ii, 1000*(time.monotonic() - start)))
+        self.ready = True
+
+    def callback(self, image, stamp):
+        if not self.flag or not self.ready:
             return
 
-        image = np.frombuffer(data.data, dtype=np.uint8).reshape(
-            data.height, data.width, -1)
-        
-        face_results = self.face_detector.detect_emotions(image)
+        box = self.face_box(image.shape[1], image.shape[0])
+        if box is not None and (box[2] == 0 or box[3] == 0):
+            #Face is off the image, nothing for FER to look at
+            return
+        if box is not None:
+            face_results = self.face_detector.detect_emotions(image, face_rectangles=[box])
+        else:
+            face_results = self.face_detector.detect_emotions(image)
         if len(face_results) > 0:
             emotion_names = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
             emotions = [face_results[0]['emotions'][e] for e in emotion_names]
 
             emotion_msg = Float64MultiArray()
             emotion_msg.data = emotions
-            face_pub.publish(emotion_msg)
+            self.face_pub.publish(emotion_msg)
             
 
 
+def start_tracking(active=True):
+    #Camera, trackers, warm-up and the pause/resume service, shared by this node and
+    #by session scripts that run tracking in-process
+    camera = CameraStream()
+    roi = rospy.get_param('~pose_roi', False)
+    governor = None
+    if rospy.get_param('~adaptive_quality', False):
+        governor = PoseGovernor(rospy.get_param('~latency_budget', 0.05))
+    pose_tracking = PoseTracking(camera, rospy.get_param('~pose_rate', 0),
+                                roi=roi,
+                                inference_width=rospy.get_param('~inference_width', 256 if roi else 0),
+                                governor=governor,
+                                publish_landmarks=rospy.get_param('~publish_landmarks', False))
+    face_tracking = FaceTracking(camera, rospy.get_param('~face_rate', 2.0), pose_tracking)
+    face_enabled = rospy.get_param('~face_tracking', False)
+
+    #Warm up in the background and let the session know once the models are hot
+    ready_pub = rospy.Publisher('pose_tracking/ready', Bool, queue_size=1, latch=True)
+    ready_pub.publish(Bool(data=False))
+
+    def warm_up():
+        start = time.monotonic()
+        #Prefer a real camera frame, fall back to a blank one if the camera is not up yet
+        seq, stamp, image = camera.wait_for_frame(0, timeout=5.0)
+        if image is None:
+            image = np.zeros((480, 640, 3), dtype=np.uint8)
+        pose_tracking.warm_up(image)
+        face_tracking.warm_up(image)
+        rospy.loginfo('Tracking ready after {:.1f} s'.format(time.monotonic() - start))
+        ready_pub.publish(Bool(data=True))
+
+    warm_up_thread = threading.Thread(target=warm_up, daemon=True)
+    warm_up_thread.start()
+
+    #Session scripts pause inference during rests, the models stay loaded for an instant resume
+    def set_active(req):
+        pose_tracking.roi = None
+        pose_tracking.flag = req.data
+        face_tracking.flag = req.data and face_enabled
+        rospy.loginfo('Pose tracking {}'.format('resumed' if req.data else 'paused'))
+        return SetBoolResponse(success=True, message='')
+
+    rospy.Service('pose_tracking/set_active', SetBool, set_active)
+
+    pose_tracking.flag = active
+    face_tracking.flag = active and face_enabled
+
+    return camera, pose_tracking, face_tracking, warm_up_thread
+
+
 if __name__ == '__main__':
     
     rospy.init_node('pose_tracking', anonymous=True)
-    
-    angle_pub = rospy.Publisher('joint_angles', Float64MultiArray, queue_size=10)
-    face_pub = rospy.Publisher('facial_features', Float64MultiArray, queue_size=10)
-    tz = timezone('EST')
-
-    #Start with exercise 1, set 1
-    pose_tracking = PoseTracking()
-    face_tracking = FaceTracking()
-    rospy.sleep(5)
 
     inittime = datetime.now(tz)
     
     MODE = 'live' #live or recording
 
     if MODE == 'recording':
+        camera, pose_tracking, face_tracking, warm_up_thread = start_tracking(active=False)
+
+        #Frames are streamed to disk as they arrive
+        filename = './PoseTrackingData_{}'.format(inittime.strftime("%m_%d_%Y_%H_%M_%S"))
+        pose_tracking.recorder = PoseRecorder(filename, pose_tracking.landmark_points, pose_tracking.joints)
 
+        warm_up_thread.join()
         print('Recording!')
-        while (datetime.now(tz) - inittime).total_seconds() < 60:        
-                
-            pose_tracking.flag = True
+        pose_tracking.flag = True
+        rospy.sleep(60)
         
         pose_tracking.flag = False
         print('Done with exercise')
-        pose_tracking.sub.unregister()
-        filename = './PoseTrackingData_{}.npz'.format(inittime.strftime("%m_%d_%Y_%H_%M_%S"))
-
-        np.savez(filename, landmarks=np.array(pose_tracking.all_landmarks), 
-                            times=np.array(pose_tracking.all_times), 
-                            angles=np.array(pose_tracking.all_angles), 
-                            landmark_points=pose_tracking.landmark_points, 
-                            joints=pose_tracking.joints)
+        camera.unregister()
+        pose_tracking.recorder.close()
+
+        save_npz(filename, filename + '.npz', tz)
     else:
-        pose_tracking.flag = True
-        face_tracking.flag = False
+        camera, pose_tracking, face_tracking, warm_up_thread = start_tracking()
         rospy.spin()
-
-    
-    
-
-
-
-
-
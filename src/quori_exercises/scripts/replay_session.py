@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import time
+import argparse
+from datetime import timedelta
+import numpy as np
+
+from Clock import VirtualClock
+from EventLog import setup_logging, shutdown_logging, read_events
+from ExerciseEval import ExerciseEval
+from FeedbackController import FeedbackController
+from RepStore import RepStore
+
+#Feeds a saved session back through ExerciseEval and FeedbackController on a virtual clock set
+#from the recorded frame times, so it runs as fast as the evaluation allows and gives the same
+#messages and gestures every time. With the session's JSONL event log, speech lengths, gesture
+#seeds and session messages come from the log and the replayed feedback is checked against it.
+#Run from the workspace root like the session scripts:
+#  python src/quori_exercises/scripts/replay_session.py Participant_1_Robot_3.npz --log Participant_1_Robot_3.jsonl --check
+
+def replay(filename, robot_num, seed=0, rep_store=None, recorded_events=None):
+    data = np.load(filename, allow_pickle=True)
+    if 'exercise_names' in data:
+        exercise_names = list(data['exercise_names'])
+    else:
+        exercise_names = [str(data['exercise_name'])]
+
+    #Gestures for the no-case reaction are randomized
+    np.random.seed(seed)
+
+    clock = VirtualClock()
+    feedback_controller = FeedbackController(True, '', robot_num, clock=clock)
+    exercise_eval = ExerciseEval(True, feedback_controller)
+    exercise_eval.rep_store = rep_store
+
+    #Measured speech lengths, seeds of each set and session messages (said at their logged times)
+    set_seeds = []
+    session_messages = []
+    for record in recorded_events if recorded_events is not None else []:
+        if record['event'] == 'speech' and record['completed']:
+            feedback_controller.durations[record['text']] = record['duration']
+        elif record['event'] == 'set_start':
+            set_seeds.append(record['seed'])
+        elif record['event'] == 'message' and record['priority'] >= 2 and not record['skipped']:
+            session_messages.append(record)
+
+    def say_session_messages(until):
+        while len(session_messages) > 0 and session_messages[0]['time'] <= until:
+            record = session_messages.pop(0)
+            clock.set(record['time'])
+            feedback_controller.message(record['text'], record['priority'], record['key'])
+
+    for set_num, exercise_name in enumerate(exercise_names):
+        angles = data['angles'][set_num]
+        times = data['times'][set_num]
+        if len(times) == 0:
+            continue
+
+        feedback_controller.logger.info('Replaying set {} of {} ({} frames)'.format(set_num+1, exercise_name, len(times)))
+        say_session_messages(times[0].timestamp())
+        clock.set(times[0].timestamp())
+        feedback_controller.start_new_set(set_seeds[set_num] if set_num < len(set_seeds) else None)
+        exercise_eval.start_new_set(exercise_name)
+        exercise_eval.flag = True
+
+        for angle, t in zip(angles, times):
+            say_session_messages(t.timestamp())
+            clock.set(t.timestamp())
+            exercise_eval.ingest(angle)
+
+        #The live session evaluates the last rep on the first frame after recording stops
+        exercise_eval.flag = False
+        exercise_eval.ingest(angles[-1])
+
+    return data, exercise_eval
+
+def compare(data, exercise_eval):
+    #Rep evaluations that differ from the ones saved during the session
+    mismatches = []
+    for set_num, (recorded, replayed) in enumerate(zip(data['feedback'], exercise_eval.feedback)):
+        if len(recorded) != len(replayed):
+            mismatches.append('set {}: {} reps recorded, {} replayed'.format(set_num+1, len(recorded), len(replayed)))
+        for rep, (a, b) in enumerate(zip(recorded, replayed)):
+            if a != b:
+                mismatches.append('set {} rep {}: recorded {}, replayed {}'.format(set_num+1, rep+1, a, b))
+    return mismatches
+
+def feedback_events(events):
+    #Rep feedback messages (said or skipped) and reaction gestures, in order
+    messages = [(r['text'], r['key'], r['skipped']) for r in events if r['event'] == 'message' and r['priority'] < 2]
+    gestures = [r for r in events if r['event'] == 'gesture']
+    return messages, gestures
+
+def same_gesture(a, b):
+    if a['case'] != b['case'] or (a['expression'] is None) != (b['expression'] is None):
+        return False
+    if a['expression'] is not None and (a['expression'][0] != b['expression'][0] or not np.isclose(a['expression'][1], b['expression'][1])):
+        return False
+    for key in ['start', 'end']:
+        if (a[key] is None) != (b[key] is None) or (a[key] is not None and not np.allclose(a[key], b[key])):
+            return False
+    return True
+
+def compare_events(recorded_events, feedback_controller):
+    #Messages and gestures that differ from the ones in the session's event log
+    mismatches = []
+    recorded_messages, recorded_gestures = feedback_events(recorded_events)
+    replayed_messages, replayed_gestures = feedback_events(feedback_controller.event_history)
+
+    if len(recorded_messages) != len(replayed_messages):
+        mismatches.append('{} feedback messages recorded, {} replayed'.format(len(recorded_messages), len(replayed_messages)))
+    for ind, (a, b) in enumerate(zip(recorded_messages, replayed_messages)):
+        if a != b:
+            mismatches.append('message {}: recorded {}, replayed {}'.format(ind+1, a, b))
+
+    if len(recorded_gestures) != len(replayed_gestures):
+        mismatches.append('{} gestures recorded, {} replayed'.format(len(recorded_gestures), len(replayed_gestures)))
+    for ind, (a, b) in enumerate(zip(recorded_gestures, replayed_gestures)):
+        if not same_gesture(a, b):
+            mismatches.append('gesture {}: recorded {} {}, replayed {} {}'.format(ind+1, a['case'], a['expression'], b['case'], b['expression']))
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a saved session on a virtual clock')
+    parser.add_argument('filename', help='npz file in src/quori_exercises/saved_data/ (or a path)')
+    parser.add_argument('--robot', type=int, help='robot number, read from the file name by default')
+    parser.add_argument('--events', help='write the replayed events to this JSONL file')
+    parser.add_argument('--log', help='JSONL event log of the session, in src/quori_exercises/saved_logs/ (or a path)')
+    parser.add_argument('--check', action='store_true', help='exit with an error if rep evaluations, messages or gestures differ from the recording')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reps', metavar='DIR', help='write the replayed reps to a RepStore in this directory')
+    args = parser.parse_args()
+
+    filename = args.filename
+    if not os.path.exists(filename):
+        filename = 'src/quori_exercises/saved_data/{}'.format(filename)
+
+    robot_num = args.robot
+    if robot_num is None:
+        match = re.search(r'Robot_(\d+)', os.path.basename(filename))
+        if match is None:
+            parser.error('could not read the robot number from {}, pass --robot'.format(filename))
+        robot_num = int(match.group(1))
+
+    recorded_events = None
+    if args.log is not None:
+        log_filename = args.log
+        if not os.path.exists(log_filename):
+            log_filename = 'src/quori_exercises/saved_logs/{}'.format(log_filename)
+        recorded_events = list(read_events(log_filename))
+
+    if args.events is not None:
+        setup_logging(None, args.events)
+
+    rep_store = None
+    if args.reps is not None:
+        match = re.search(r'Participant_([^_]+)', os.path.basename(filename))
+        rep_store = RepStore(args.reps, participant=match.group(1) if match is not None else '', robot=robot_num)
+
+    start = time.time()
+    data, exercise_eval = replay(filename, robot_num, args.seed, rep_store, recorded_events)
+    exercise_eval.close()
+    if rep_store is not None:
+        rep_store.flush()
+    elapsed = time.time() - start
+    feedback_controller = exercise_eval.feedback_controller
+
+    session_length = sum([(times[-1] - times[0]).total_seconds() for times in data['times'] if len(times) > 0])
+    print('Replayed {:.0f} s of recording in {:.1f} s ({:.0f}x)'.format(session_length, elapsed, session_length/max(elapsed, 1e-6)))
+    print('{} messages, {} gesture keyframes'.format(len(feedback_controller.message_log), len(feedback_controller.gesture_log)))
+    for m, end in zip(feedback_controller.message_log, feedback_controller.message_time_stamps):
+        said = end - timedelta(seconds=feedback_controller.message_duration(m))
+        print('  {}  {}'.format(said.strftime('%H:%M:%S.%f')[:-3], m))
+
+    mismatches = compare(data, exercise_eval)
+    if recorded_events is not None:
+        mismatches += compare_events(recorded_events, feedback_controller)
+    for mismatch in mismatches:
+        print(mismatch)
+    shutdown_logging()
+
+    if args.check and len(mismatches) > 0:
+        sys.exit(1)
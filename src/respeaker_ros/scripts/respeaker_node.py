@@ -14,7 +14,12 @@ import os
 import rospy
 import struct
 import sys
+import threading
 import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from audio_common_msgs.msg import AudioData
 from geometry_msgs.msg import PoseStamped
 from std_msgs.msg import Bool, Int32, ColorRGBA
@@ -116,6 +121,8 @@ class RespeakerInterface(object):
             raise RuntimeError("Failed to find Respeaker device")
         rospy.loginfo("Initializing Respeaker device")
         self.dev.reset()
+        # control transfers come from the poller, dynamic_reconfigure and LED callbacks
+        self.lock = threading.RLock()
         self.pixel_ring = usb_pixel_ring_v2.PixelRing(self.dev)
         self.set_led_think()
         time.sleep(5)  # it will take 5 seconds to re-recognize as audio device
@@ -147,9 +154,10 @@ class RespeakerInterface(object):
         else:
             payload = struct.pack(b'ifi', data[1], float(value), 0)
 
-        self.dev.ctrl_transfer(
-            usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
-            0, 0, id, payload, self.TIMEOUT)
+        with self.lock:
+            self.dev.ctrl_transfer(
+                usb.util.CTRL_OUT | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
+                0, 0, id, payload, self.TIMEOUT)
 
     def read(self, name):
         try:
@@ -165,13 +173,11 @@ class RespeakerInterface(object):
 
         length = 8
 
-        try:
+        # USBError is left to the caller, RespeakerPoller retries transient ones
+        with self.lock:
             response = self.dev.ctrl_transfer(
                 usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
                 0, cmd, id, length, self.TIMEOUT)
-        except usb.core.USBError as e:
-            rospy.logerr(e)
-            rospy.signal_shutdown('Shutdown this node because of USBError')
 
         if sys.version_info.major == 2:
             response = struct.unpack(b'ii', response.tostring())
@@ -186,16 +192,19 @@ class RespeakerInterface(object):
         return result
 
     def set_led_think(self):
-        self.pixel_ring.set_brightness(10)
-        self.pixel_ring.think()
+        with self.lock:
+            self.pixel_ring.set_brightness(10)
+            self.pixel_ring.think()
 
     def set_led_trace(self):
-        self.pixel_ring.set_brightness(20)
-        self.pixel_ring.trace()
+        with self.lock:
+            self.pixel_ring.set_brightness(20)
+            self.pixel_ring.trace()
 
     def set_led_color(self, r, g, b, a):
-        self.pixel_ring.set_brightness(int(20 * a))
-        self.pixel_ring.set_color(r=int(r*255), g=int(g*255), b=int(b*255))
+        with self.lock:
+            self.pixel_ring.set_brightness(int(20 * a))
+            self.pixel_ring.set_color(r=int(r*255), g=int(g*255), b=int(b*255))
 
     def set_vad_threshold(self, db):
         self.write('GAMMAVAD_SR', db)
@@ -209,9 +218,10 @@ class RespeakerInterface(object):
 
     @property
     def version(self):
-        return self.dev.ctrl_transfer(
-            usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
-            0, 0x80, 0, 1, self.TIMEOUT)[0]
+        with self.lock:
+            return self.dev.ctrl_transfer(
+                usb.util.CTRL_IN | usb.util.CTRL_TYPE_VENDOR | usb.util.CTRL_RECIPIENT_DEVICE,
+                0, 0x80, 0, 1, self.TIMEOUT)[0]
 
     def close(self):
         """
@@ -220,6 +230,75 @@ class RespeakerInterface(object):
         usb.util.dispose_resources(self.dev)
 
 
+class RespeakerPoller(object):
+    """
+    Reads read-only parameters on a background thread, each at its own rate,
+    and keeps the latest value of each with the time it was read
+    """
+    def __init__(self, respeaker, rates, max_backoff=2.0, error_timeout=10.0):
+        self.respeaker = respeaker
+        self.rates = dict(rates)
+        self.max_backoff = max_backoff
+        self.error_timeout = error_timeout
+        self.values = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="respeaker_poller")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(1.0)
+
+    def get(self, name, max_age=None):
+        """
+        returns (value, ROS time in seconds) or (None, None) if it was never
+        read or is older than max_age seconds
+        """
+        with self.lock:
+            value, stamp = self.values.get(name, (None, None))
+        if stamp is None or (max_age is not None and rospy.get_time() - stamp > max_age):
+            return None, None
+        return value, stamp
+
+    def run(self):
+        now = time.time()
+        due = dict((name, now) for name in self.rates)
+        backoff = dict((name, 0.0) for name in self.rates)
+        failing_since = None
+        while self.running and not rospy.is_shutdown():
+            name = min(due, key=due.get)
+            delay = due[name] - time.time()
+            if delay > 0:
+                time.sleep(min(delay, 0.1))
+                continue
+            try:
+                value = self.respeaker.read(name)
+            except usb.core.USBError as e:
+                # back off on this parameter, give up if the device stays unreachable
+                backoff[name] = min(self.max_backoff, max(0.1, 2 * backoff[name]))
+                due[name] = time.time() + backoff[name]
+                if failing_since is None:
+                    failing_since = time.time()
+                rospy.logwarn_throttle(1.0, "Failed to read %s: %s (retrying in %.1f s)" % (name, e, backoff[name]))
+                if time.time() - failing_since > self.error_timeout:
+                    rospy.logerr(e)
+                    rospy.signal_shutdown('Shutdown this node because of USBError')
+                    break
+                continue
+            with self.lock:
+                self.values[name] = (value, rospy.get_time())
+            backoff[name] = 0.0
+            failing_since = None
+            due[name] = max(due[name] + 1.0 / self.rates[name], time.time())
+
+
 class RespeakerAudio(object):
     def __init__(self, on_audio, channel=0, suppress_error=True):
         self.on_audio = on_audio
@@ -298,6 +377,123 @@ class RespeakerAudio(object):
             self.stream.stop_stream()
 
 
+class RingBuffer(object):
+    """
+    Preallocated buffer keeping the last `size` bytes written
+    """
+    def __init__(self, size):
+        self.size = max(0, int(size))
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+        self.end = 0
+        self.length = 0
+
+    def write(self, data):
+        if self.size == 0:
+            return
+        data = memoryview(data)
+        if len(data) >= self.size:
+            self.view[:] = data[len(data) - self.size:]
+            self.end = 0
+            self.length = self.size
+            return
+        end = self.end + len(data)
+        if end <= self.size:
+            self.view[self.end:end] = data
+        else:
+            first = self.size - self.end
+            self.view[self.end:] = data[:first]
+            self.view[:end - self.size] = data[first:]
+        self.end = end % self.size
+        self.length = min(self.size, self.length + len(data))
+
+    def read_into(self, out, length=None):
+        """
+        write the buffered bytes (or the last `length` of them), oldest first, to `out`
+        """
+        length = self.length if length is None else min(self.length, max(0, int(length)))
+        begin = (self.end - length) % self.size if self.size > 0 else 0
+        if begin + length <= self.size:
+            out.write(self.view[begin:begin + length])
+        else:
+            out.write(self.view[begin:])
+            out.write(self.view[:self.end])
+
+
+class SpeechBuffer(object):
+    """
+    Byte buffer preallocated for a whole utterance, doubling if it runs out
+    """
+    def __init__(self, capacity):
+        self.buffer = bytearray(max(1, int(capacity)))
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def write(self, data):
+        end = self.length + len(data)
+        if end > len(self.buffer):
+            self.buffer.extend(bytearray(max(end, 2 * len(self.buffer)) - len(self.buffer)))
+        self.buffer[self.length:end] = data
+        self.length = end
+
+    def tobytes(self):
+        return memoryview(self.buffer)[:self.length].tobytes()
+
+    def truncate(self, length):
+        self.length = min(self.length, max(0, int(length)))
+
+    def clear(self):
+        self.length = 0
+
+
+class SoftwareVAD(object):
+    """
+    Frame level voice activity from the PCM stream. A frame is voiced when its
+    energy is `threshold` dB above the tracked noise floor (and above
+    `min_energy` dB) and most of its power is in the speech band.
+    """
+    def __init__(self, rate, frame_length=0.016, threshold=10.0, min_energy=40.0,
+                 band=(300.0, 3400.0), band_ratio=0.5, noise_rise=1.0):
+        self.frame_size = max(1, int(rate * frame_length))
+        self.threshold = threshold
+        self.min_energy = min_energy
+        self.band_ratio = band_ratio
+        # dB per frame the noise floor can rise while there is no quieter frame
+        self.noise_rise = noise_rise * self.frame_size / float(rate)
+        self.noise = None
+        freqs = np.fft.rfftfreq(self.frame_size, 1.0 / rate)
+        self.band = (freqs >= band[0]) & (freqs <= band[1])
+        self.window = np.hanning(self.frame_size).astype(np.float32)
+
+    def process(self, samples):
+        """
+        returns a voiced flag per frame of `samples` (int16) and the sample each
+        frame ends at, leftover samples belong to the last frame
+        """
+        count = max(1, len(samples) // self.frame_size)
+        usable = min(len(samples), count * self.frame_size)
+        frames = samples[:usable].astype(np.float32).reshape(count, -1)
+        energy = 10.0 * np.log10(np.mean(frames ** 2, axis=1) + 1.0)
+        if frames.shape[1] == self.frame_size:
+            power = np.abs(np.fft.rfft(frames * self.window, axis=1)) ** 2
+            in_band = power[:, self.band].sum(axis=1) / (power.sum(axis=1) + 1e-9)
+        else:
+            in_band = np.ones(count)
+
+        # floor follows quiet frames down right away and rises slowly
+        quietest = float(energy.min())
+        if self.noise is None:
+            self.noise = quietest
+        self.noise = min(quietest, self.noise + self.noise_rise * count)
+
+        voiced = (energy > self.noise + self.threshold) & (energy > self.min_energy) & (in_band > self.band_ratio)
+        ends = np.arange(1, count + 1) * self.frame_size
+        ends[-1] = len(samples)
+        return voiced, ends
+
+
 class RespeakerNode(object):
     def __init__(self):
         rospy.on_shutdown(self.on_shutdown)
@@ -309,10 +505,26 @@ class RespeakerNode(object):
         self.speech_continuation = rospy.get_param("~speech_continuation", 0.5)
         self.speech_max_duration = rospy.get_param("~speech_max_duration", 7.0)
         self.speech_min_duration = rospy.get_param("~speech_min_duration", 0.1)
+        # segment speech on the audio stream instead of the device's VAD flag,
+        # padding and hangover replace speech_prefetch and speech_continuation
+        self.use_software_vad = rospy.get_param("~software_vad", False)
+        self.vad_padding = rospy.get_param("~vad_padding", 0.1)
+        self.vad_hangover = rospy.get_param("~vad_hangover", 0.3)
+        self.vad_threshold = rospy.get_param("~vad_threshold", 10.0)
+        self.vad_min_energy = rospy.get_param("~vad_min_energy", 40.0)
+        # USB polling rates in Hz, other read-only parameters can be added by name
+        poll_rates = {'DOAANGLE': rospy.get_param("~doa_rate", self.update_rate)}
+        if not self.use_software_vad:
+            poll_rates['VOICEACTIVITY'] = rospy.get_param("~vad_rate", self.update_rate)
+        poll_rates.update(rospy.get_param("~poll_rates", {}))
+        usb_max_backoff = rospy.get_param("~usb_max_backoff", 2.0)
+        usb_error_timeout = rospy.get_param("~usb_error_timeout", 10.0)
+        # cached values older than this are treated as unknown
+        self.usb_max_age = rospy.get_param("~usb_max_age", 1.0)
         suppress_pyaudio_error = rospy.get_param("~suppress_pyaudio_error", True)
         #
         self.respeaker = RespeakerInterface()
-        self.speech_audio_buffer = b""
+        self.poller = RespeakerPoller(self.respeaker, poll_rates, usb_max_backoff, usb_error_timeout)
         self.is_speeching = False
         self.speech_stopped = rospy.Time(0)
         self.prev_is_voice = None
@@ -328,16 +540,43 @@ class RespeakerNode(object):
         self.dyn_srv = Server(RespeakerConfig, self.on_config)
         # start
         self.respeaker_audio = RespeakerAudio(self.on_audio, suppress_error=suppress_pyaudio_error)
-        self.speech_prefetch_bytes = int(
-            self.speech_prefetch * self.respeaker_audio.rate * self.respeaker_audio.bitdepth / 8.0)
-        self.speech_prefetch_buffer = b""
+        self.speech_prefetch_bytes = self.seconds_to_bytes(self.speech_prefetch)
+        self.software_vad = None
+        if self.use_software_vad:
+            self.software_vad = SoftwareVAD(self.respeaker_audio.rate, threshold=self.vad_threshold,
+                                            min_energy=self.vad_min_energy)
+            self.vad_padding_bytes = self.seconds_to_bytes(self.vad_padding)
+            self.vad_hangover_bytes = self.seconds_to_bytes(self.vad_hangover)
+            self.speech_end = 0
+            self.silence_bytes = 0
+            # the ring also holds the chunk speech starts in
+            self.speech_prefetch_bytes = self.vad_padding_bytes + 4 * 1024 * self.respeaker_audio.bitwidth
+        self.speech_prefetch_buffer = RingBuffer(self.speech_prefetch_bytes)
+        # audio callback fills one speech buffer while the other is published
+        self.speech_buffer_bytes = self.speech_prefetch_bytes + self.seconds_to_bytes(self.speech_max_duration)
+        self.speech_audio_buffer = SpeechBuffer(self.speech_buffer_bytes)
+        self.spare_speech_audio_buffer = SpeechBuffer(self.speech_buffer_bytes)
+        self.speech_lock = threading.Lock()
+        if self.use_software_vad:
+            # utterances go out as soon as they end, off the audio thread
+            self.finished_speech = queue.Queue()
+            self.free_speech_buffers = queue.Queue()
+            self.free_speech_buffers.put(self.spare_speech_audio_buffer)
+            self.speech_thread = threading.Thread(target=self.speech_publisher, name="respeaker_speech")
+            self.speech_thread.daemon = True
+            self.speech_thread.start()
         self.respeaker_audio.start()
+        self.poller.start()
         self.info_timer = rospy.Timer(rospy.Duration(1.0 / self.update_rate),
                                       self.on_timer)
         self.timer_led = None
         self.sub_led = rospy.Subscriber("status_led", ColorRGBA, self.on_status_led)
 
     def on_shutdown(self):
+        try:
+            self.poller.stop()
+        except:
+            pass
         try:
             self.respeaker.close()
         except:
@@ -373,31 +612,98 @@ class RespeakerNode(object):
                                        lambda e: self.respeaker.set_led_trace(),
                                        oneshot=True)
 
+    def seconds_to_bytes(self, seconds):
+        return int(seconds * self.respeaker_audio.rate * self.respeaker_audio.bitdepth / 8.0)
+
     def on_audio(self, data):
         self.pub_audio.publish(AudioData(data=data))
-        if self.is_speeching:
-            if len(self.speech_audio_buffer) == 0:
-                self.speech_audio_buffer = self.speech_prefetch_buffer
-            self.speech_audio_buffer += data
+        if self.software_vad is not None:
+            self.segment_speech(data)
+            return
+        # only copies this chunk (and the prefetch once per utterance)
+        with self.speech_lock:
+            if self.is_speeching:
+                if len(self.speech_audio_buffer) == 0:
+                    self.speech_prefetch_buffer.read_into(self.speech_audio_buffer)
+                self.speech_audio_buffer.write(data)
+            else:
+                self.speech_prefetch_buffer.write(data)
+
+    def segment_speech(self, data):
+        """
+        software VAD: speech starts vad_padding before the first voiced frame and
+        ends vad_padding after the last one, once vad_hangover has passed without voice
+        """
+        voiced, ends = self.software_vad.process(np.frombuffer(data, dtype=np.int16))
+        ends = ends * self.respeaker_audio.bitwidth
+        voiced_frames = np.flatnonzero(voiced)
+        buf = self.speech_audio_buffer
+
+        if not self.is_speeching:
+            self.speech_prefetch_buffer.write(data)
+            if len(voiced_frames) == 0:
+                return
+            first = ends[voiced_frames[0] - 1] if voiced_frames[0] > 0 else 0
+            self.speech_prefetch_buffer.read_into(buf, len(data) - first + self.vad_padding_bytes)
+            self.is_speeching = True
+            self.pub_vad.publish(Bool(data=True))
+        else:
+            buf.write(data)
+
+        if len(voiced_frames) > 0:
+            self.speech_end = len(buf) - len(data) + ends[voiced_frames[-1]]
+            self.silence_bytes = len(data) - ends[voiced_frames[-1]]
         else:
-            self.speech_prefetch_buffer += data
-            self.speech_prefetch_buffer = self.speech_prefetch_buffer[-self.speech_prefetch_bytes:]
+            self.silence_bytes += len(data)
+
+        if self.silence_bytes >= self.vad_hangover_bytes:
+            buf.truncate(self.speech_end + self.vad_padding_bytes)
+            try:
+                self.speech_audio_buffer = self.free_speech_buffers.get_nowait()
+            except queue.Empty:
+                self.speech_audio_buffer = SpeechBuffer(self.speech_buffer_bytes)
+            self.is_speeching = False
+            self.silence_bytes = 0
+            self.pub_vad.publish(Bool(data=False))
+            self.finished_speech.put(buf)
+
+    def speech_publisher(self):
+        while not rospy.is_shutdown():
+            try:
+                buf = self.finished_speech.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.publish_speech(buf)
+            self.free_speech_buffers.put(buf)
+
+    def publish_speech(self, buf):
+        duration = 8.0 * len(buf) * self.respeaker_audio.bitwidth
+        duration = duration / self.respeaker_audio.rate / self.respeaker_audio.bitdepth
+        rospy.loginfo("Speech detected for %.3f seconds" % duration)
+        if self.speech_min_duration <= duration < self.speech_max_duration:
+
+            self.pub_speech_audio.publish(AudioData(data=buf.tobytes()))
+        buf.clear()
 
     def on_timer(self, event):
         stamp = event.current_real or rospy.Time.now()
-        is_voice = self.respeaker.is_voice()
-        doa_rad = math.radians(self.respeaker.direction - 180.0)
-        doa_rad = angles.shortest_angular_distance(
-            doa_rad, math.radians(self.doa_yaw_offset))
-        doa = int(math.degrees(doa_rad))
-
-        # vad
-        if is_voice != self.prev_is_voice:
+        # latest values from the poller, nothing here waits on USB
+        # (a stale VAD reading counts as no voice so an utterance still ends)
+        is_voice, vad_stamp = self.poller.get('VOICEACTIVITY', max_age=self.usb_max_age)
+        direction, _ = self.poller.get('DOAANGLE', max_age=self.usb_max_age)
+
+        # vad (published from the audio callback with the software VAD)
+        if self.software_vad is None and is_voice is not None and is_voice != self.prev_is_voice:
             self.pub_vad.publish(Bool(data=is_voice))
             self.prev_is_voice = is_voice
 
         # doa
-        if doa != self.prev_doa:
+        if direction is not None:
+            doa_rad = math.radians(direction - 180.0)
+            doa_rad = angles.shortest_angular_distance(
+                doa_rad, math.radians(self.doa_yaw_offset))
+            doa = int(math.degrees(doa_rad))
+        if direction is not None and doa != self.prev_doa:
             self.pub_doa_raw.publish(Int32(data=doa))
             self.prev_doa = doa
 
@@ -414,20 +720,20 @@ class RespeakerNode(object):
             self.pub_doa.publish(msg)
 
         # speech audio
+        if self.software_vad is not None:
+            return
         if is_voice:
-            self.speech_stopped = stamp
+            self.speech_stopped = rospy.Time.from_sec(vad_stamp)
         if stamp - self.speech_stopped < rospy.Duration(self.speech_continuation):
             self.is_speeching = True
         elif self.is_speeching:
-            buf = self.speech_audio_buffer
-            self.speech_audio_buffer = b""
-            self.is_speeching = False
-            duration = 8.0 * len(buf) * self.respeaker_audio.bitwidth
-            duration = duration / self.respeaker_audio.rate / self.respeaker_audio.bitdepth
-            rospy.loginfo("Speech detected for %.3f seconds" % duration)
-            if self.speech_min_duration <= duration < self.speech_max_duration:
-
-                self.pub_speech_audio.publish(AudioData(data=buf))
+            # swap buffers so the audio callback never waits on publishing
+            with self.speech_lock:
+                buf = self.speech_audio_buffer
+                self.speech_audio_buffer = self.spare_speech_audio_buffer
+                self.spare_speech_audio_buffer = buf
+                self.is_speeching = False
+            self.publish_speech(buf)
 
 
 if __name__ == '__main__':